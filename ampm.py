@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+AM and PM plans of every school in one run.
+
+Each tier's Tier*_pm.csv and each school's matrix are read once and serve both
+periods. In the morning the school is where a route ends rather than where it
+starts, so the AM time matrix is the transpose of the PM one: going from node i
+to node j in the morning takes as long as going from j to i in the afternoon.
+An AM route driven backwards is therefore a PM-shaped route over the transpose
+of the AM matrix, which is the PM matrix again, so the AM model of a school is
+its PM model with the AM bus capacity and maximum route time. When both periods
+have the same limits the PM routes, reversed, are the AM routes and every school
+is solved once.
+
+The morning run backwards in time is an afternoon run over the tiers in reverse,
+so the AM routes are chained into buses by the same engines with the tiers
+reversed. AM buses are then numbered after the PM bus that drives most of the
+same routes, and both plans are written side by side to bus_assignments_ampm.csv,
+one row per bus and tier, with Tier*\\SCHOOL_amRouteData.csv next to the PM files.
+
+    python ampm.py
+"""
+
+import datetime
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from ortools.graph.python import linear_sum_assignment
+
+import pm_new
+from distance_matrix import load_school_matrix
+from route_store import Route, build_routes, export_routes
+from bus_chaining import assign_buses, buses_in_service, which_tier
+from scenarios import with_limits, solve_variant
+
+PERIODS = ('am', 'pm')
+
+# rows of every tier and (distance, time) planes of every school, each read once
+def load_inputs(school_codes, directory=''):
+    stops_data = {}
+    matrices = {}
+    for tier, schools in enumerate(school_codes, 1):
+        stops_data[tier] = pm_new.load_tier_data(tier, directory)
+        for school in schools:
+            school_stops = stops_data[tier][stops_data[tier][:, 4] == school]
+            matrices[school] = load_school_matrix(
+                os.path.join(directory, 'Tier'+str(tier)+'\\'+school+'_pmDistance.csv'), school_stops[1:, 5])
+    return stops_data, matrices
+
+# AM time matrix of a school's data model, with the school as the destination
+def am_time_matrix(data):
+    return np.asarray(data['time_matrix']).T
+
+# route of the AM plan: the stops of a PM-shaped route in reverse, ending at the
+# school, timed along the AM time matrix
+def am_route(route, am_matrix):
+    stops = route.stops[::-1]
+    return Route(school=route.school,
+                 tier=route.tier,
+                 route=route.route,
+                 stops=stops,
+                 names=route.names[::-1],
+                 latitude=route.latitude[::-1],
+                 longitude=route.longitude[::-1],
+                 students=route.students[::-1],
+                 time=int(sum(am_matrix[i][j] for i, j in zip(stops[:-1], stops[1:]))),
+                 load=route.load,
+                 vehicle_type=route.vehicle_type)
+
+# solve every school once per distinct (bus_capacity, max_route_time) of limits
+# ({period: limits}); returns {period: {school: opt_routes}}, the AM ones PM-shaped,
+# and the data model of every school
+def solve_periods(school_codes, stops_data, matrices, num_buses, limits, options=None, workers=1):
+    options = dict(pm_new.SOLVE_OPTIONS, **(options or {}))
+    bus_capacity, max_route_time = next(iter(limits.values()))
+    base = {}
+    for tier, schools in enumerate(school_codes, 1):
+        for school in schools:
+            base[school] = pm_new.create_data_model(school, None, stops_data[tier],
+                                                    [bus_capacity for i in range(num_buses)], max_route_time,
+                                                    matrix=matrices[school])
+
+    jobs = [(school, limit) for limit in sorted(set(limits.values())) for school in base]
+    print('{} periods, {} school solves instead of {}'.format(len(limits), len(jobs), len(limits) * len(base)))
+    variants = [with_limits(base[school], *limit) for school, limit in jobs]
+    if workers <= 1:
+        solved = [solve_variant(variant, options) for variant in variants]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            solved = list(executor.map(solve_variant, variants, [options for variant in variants]))
+    solutions = {job: opt_routes for job, opt_routes in zip(jobs, solved)}
+    return {period: {school: solutions[(school, limit)] for school in base} for period, limit in limits.items()}, base
+
+# chain AM routes (PM-shaped) into buses: the afternoon chaining over the tiers in
+# reverse, then each bus's routes put back in morning order. The duration of an AM
+# route includes the deadhead that brings its bus to the first stop
+def chain_am(routes, school_codes, max_route_time, num_buses, engine='matching', provider=None):
+    bus_routes, deadhead = assign_buses(routes, school_codes[::-1], max_route_time, num_buses, engine,
+                                        provider=provider)
+    return {bus: assignments[::-1] for bus, assignments in bus_routes.items()}, deadhead
+
+# AM bus routes numbered after the PM buses, each AM bus taking the number of the PM
+# bus it shares the most routes with; AM buses left over get numbers after the PM ones
+def match_bus_numbers(am_bus_routes, pm_bus_routes):
+    am_buses = [bus for bus, assignments in am_bus_routes.items() if assignments]
+    pm_buses = [bus for bus, assignments in pm_bus_routes.items() if assignments]
+    pm_sets = [set((school, route) for school, route, duration in pm_bus_routes[bus]) for bus in pm_buses]
+    size = max(len(am_buses), len(pm_buses))
+    if size == 0:
+        return {}
+
+    assignment = linear_sum_assignment.SimpleLinearSumAssignment()
+    for i in range(size):
+        am_set = (set((school, route) for school, route, duration in am_bus_routes[am_buses[i]])
+                  if i < len(am_buses) else set())
+        for j in range(size):
+            assignment.add_arc_with_cost(i, j, -len(am_set & pm_sets[j]) if j < len(pm_buses) else 0)
+    if assignment.solve() != assignment.OPTIMAL:
+        raise RuntimeError('Bus numbering failed')
+
+    numbered = {}
+    next_bus = max(pm_buses + [-1]) + 1
+    for i, bus in enumerate(am_buses):
+        j = assignment.right_mate(i)
+        if j < len(pm_buses):
+            numbered[pm_buses[j]] = am_bus_routes[bus]
+        else:
+            numbered[next_bus] = am_bus_routes[bus]
+            next_bus += 1
+    return numbered
+
+# rows of bus_assignments.csv: bus, school, route, duration, load, type of the bus
+def assignment_table(bus_routes, routes):
+    return pd.DataFrame([[bus, school, route, duration, routes[school][route].load,
+                          routes[school][route].vehicle_type]
+                         for bus, assignments in bus_routes.items() for school, route, duration in assignments],
+                        columns=['bus', 'school', 'route', 'duration', 'load', 'type'])
+
+# one row per bus and tier with the route the bus drives in each period side by side
+def side_by_side(bus_routes, routes, school_codes):
+    columns = ['bus', 'tier']
+    for period in bus_routes:
+        columns += [period + '_school', period + '_route', period + '_duration', period + '_load']
+    buses = sorted(set(bus for plan in bus_routes.values() for bus, assignments in plan.items() if assignments))
+    rows = []
+    for bus in buses:
+        # a bus drives at most one route of each tier
+        by_tier = {period: {which_tier(school, school_codes): (school, route, duration)
+                            for school, route, duration in plan.get(bus, [])}
+                   for period, plan in bus_routes.items()}
+        for tier in range(1, len(school_codes)+1):
+            if not any(tier in legs for legs in by_tier.values()):
+                continue
+            row = [bus, tier]
+            for period, legs in by_tier.items():
+                if tier in legs:
+                    school, route, duration = legs[tier]
+                    row += [school, route, duration, routes[period][school][route].load]
+                else:
+                    row += [None, None, None, None]
+            rows.append(row)
+    return pd.DataFrame(rows, columns=columns)
+
+# plan the periods with limits {period: (bus_capacity, max_route_time)} from one
+# load of the inputs; returns ({period: {school: [Route]}}, {period: bus routes},
+# {period: deadhead}), with the AM buses numbered after the PM ones
+def run(school_codes, limits, num_buses=97, options=None, workers=1, chaining='matching', provider=None,
+        export_route_csvs=True):
+    stops_data, matrices = load_inputs(school_codes)
+    solved, data = solve_periods(school_codes, stops_data, matrices, num_buses, limits, options, workers)
+
+    routes = {}
+    bus_routes = {}
+    deadhead = {}
+    for period in limits:
+        max_route_time = limits[period][1]
+        shaped = {school: build_routes(solved[period][school], tier, school, stops_data[tier])
+                  for tier, schools in enumerate(school_codes, 1) for school in schools}
+        if period == 'am':
+            bus_routes[period], deadhead[period] = chain_am(shaped, school_codes, max_route_time, num_buses,
+                                                            chaining, provider)
+            shaped = {school: [am_route(route, am_time_matrix(data[school])) for route in school_routes]
+                      for school, school_routes in shaped.items()}
+        else:
+            bus_routes[period], deadhead[period] = assign_buses(shaped, school_codes, max_route_time, num_buses,
+                                                                chaining, provider=provider)
+        routes[period] = shaped
+        print('{}: {} buses, {}sec of deadhead'.format(period.upper(), buses_in_service(bus_routes[period]),
+                                                      deadhead[period]))
+        if export_route_csvs:
+            for export in export_routes(shaped, school_codes, period=period):
+                export.result()
+
+    if 'am' in bus_routes and 'pm' in bus_routes:
+        bus_routes['am'] = match_bus_numbers(bus_routes['am'], bus_routes['pm'])
+    return routes, bus_routes, deadhead
+
+if __name__ == '__main__':
+    numBuses = 97
+    workers = 1              # number of schools solved at once
+    chaining = 'matching'    # engine that chains the routes into buses, see bus_chaining.py
+    # bus capacity and max route time (seconds) of each period; the same limits solve each school once
+    limits = {'am': (54, 2700),
+              'pm': (54, 2700)}
+    options = dict(pm_new.SOLVE_OPTIONS,
+                   cache_dir='solve_cache',  # schools solved in an earlier run are not solved again
+                   time_limit=100)
+    school_codes = [['JHS', 'LHS', 'WHS','TMS'],
+                    ['HMS', 'JBM', 'BMS', 'DJM', 'JR', 'SH'],
+                    ['MAT', 'MW', 'CBB', 'LL', 'NES', 'JBB']]
+
+    start_time = datetime.datetime.now()
+    routes, bus_routes, deadhead = run(school_codes, limits, numBuses, options, workers, chaining)
+    print('\nTime to Compute:', datetime.datetime.now()-start_time)
+    plans = side_by_side({period: bus_routes[period] for period in PERIODS if period in bus_routes}, routes,
+                         school_codes)
+    plans.to_csv('bus_assignments_ampm.csv', index=False)
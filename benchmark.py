@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the PM routing pipeline on synthetic districts.
+
+A synthetic district has the same files as the real one (Tier*\\Tier*_pm.csv,
+Tier*\\SCHOOL_pmDistance.csv, school_locations.csv), with configurable numbers of
+schools, stops per school and students per stop. Every phase of the pipeline is run
+on it under fixed seeds and its wall time, peak memory, objective and buses used
+are appended as one JSON line per phase to the results file. Memory is recorded
+twice: python_heap_peak is the peak of the Python heap (tracemalloc), which misses
+the solver's C++ heap, and rss_peak is how far the resident memory of the process
+rose above its start during the phase, sampled every RSS_INTERVAL seconds, which
+includes it. rss_peak is None where the resident memory cannot be read (it needs
+psutil or /proc).
+
+    python benchmark.py --scales 1 2 5 10 --seeds 0 1 --output benchmark_results.jsonl
+
+Scale multiplies the stops per school, so scale 10 is ten times today's stop counts.
+--neighbors 5 10 20 also runs every district with arcs pruned to that many nearest stops.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from geodesic import geodesic_distances, load_school_locations
+from bus_chaining import DETOUR_FACTOR, BUS_SPEED, CHAINING_ENGINES, last_stop_distances, assign_buses, \
+    buses_in_service
+from route_store import build_routes
+import pm_new
+
+# today's district: schools per tier and range of stops per school and students per stop
+SCHOOLS_PER_TIER = [4, 6, 6]
+STOPS_PER_SCHOOL = (8, 25)
+STUDENTS_PER_STOP = (1, 15)
+# centre of the district and how far stops spread out from their school, in degrees
+DISTRICT_CENTRE = (37.27, -76.70)
+DISTRICT_RADIUS = 0.12
+SCHOOL_RADIUS = 0.08
+RSS_INTERVAL = 0.01     # seconds between samples of the resident memory during a phase
+
+# school codes of a synthetic district, one list per tier like pm_new's school_codes
+def synthetic_school_codes(schools_per_tier=SCHOOLS_PER_TIER):
+    return [['T{}S{:02d}'.format(tier, i+1) for i in range(count)]
+            for tier, count in enumerate(schools_per_tier, 1)]
+
+# write a synthetic district into directory
+def generate_district(directory, school_codes, stops_per_school=STOPS_PER_SCHOOL,
+                      students_per_stop=STUDENTS_PER_STOP, scale=1, seed=0):
+    rng = np.random.default_rng(seed)
+    locations = []
+    for tier, schools in enumerate(school_codes, 1):
+        os.makedirs(os.path.join(directory, 'Tier'+str(tier)), exist_ok=True)
+        rows = []
+        for school in schools:
+            school_lat, school_lon = np.asarray(DISTRICT_CENTRE) + rng.uniform(-DISTRICT_RADIUS, DISTRICT_RADIUS, 2)
+            locations.append([school_lon, school_lat, school, tier])
+            num_stops = int(rng.integers(stops_per_school[0], stops_per_school[1]+1) * scale)
+            lat = np.concatenate([[school_lat], school_lat + rng.uniform(-SCHOOL_RADIUS, SCHOOL_RADIUS, num_stops)])
+            lon = np.concatenate([[school_lon], school_lon + rng.uniform(-SCHOOL_RADIUS, SCHOOL_RADIUS, num_stops)])
+            students = np.concatenate([[0], rng.integers(students_per_stop[0], students_per_stop[1]+1, num_stops)])
+
+            # road distance and driving time between every pair of stops
+            dist = (geodesic_distances(lat[:, np.newaxis], lon[:, np.newaxis], lat, lon) * DETOUR_FACTOR).astype(int)
+            times = dist // BUS_SPEED
+            for i in range(num_stops+1):
+                name = school if i == 0 else '{}_{:04d}'.format(school, i)
+                rows.append([lon[i], lat[i], '', '', school, name, '', -students[i], '', '', dist[0, i], times[0, i]])
+            cells = np.char.add(np.char.add(np.char.add('"(', dist[1:, 1:].astype(str)), ','),
+                                np.char.add(times[1:, 1:].astype(str), ')"'))
+            with open(os.path.join(directory, 'Tier'+str(tier)+'\\'+school+'_pmDistance.csv'), 'w') as f:
+                f.write('\n'.join(','.join(row) for row in cells) + '\n')
+
+        columns = ['longitude', 'latitude', 'address', 'zip', 'school', 'stop', 'grade', 'students',
+                   'am', 'pm', 'distance', 'time']
+        _write_csv(os.path.join(directory, 'Tier'+str(tier)+'\\'+'Tier'+str(tier)+'_pm.csv'), columns, rows)
+    _write_csv(os.path.join(directory, 'school_locations.csv'), ['longitude', 'latitude', 'school', 'tier'], locations)
+
+def _write_csv(filename, columns, rows):
+    import pandas as pd
+    pd.DataFrame(rows, columns=columns).to_csv(filename, index=False)
+
+@contextlib.contextmanager
+def working_directory(directory):
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+# resident memory of this process in bytes, None where it cannot be read
+def resident_memory():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+# samples the resident memory on a thread until stopped; peak is the most it rose above
+# the memory at the start
+class RssSampler(threading.Thread):
+    def __init__(self, interval=RSS_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.start_rss = resident_memory()
+        self.peak_rss = self.start_rss
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, resident_memory())
+
+    # the peak, None when the resident memory cannot be read and the sampler never ran
+    def stop(self):
+        if self.start_rss is None:
+            return None
+        self.done.set()
+        self.join()
+        return max(self.peak_rss, resident_memory()) - self.start_rss
+
+# run fn as one phase and return its result and a record of wall time and peak memory
+def measure(phase, fn, *args, **kwargs):
+    sampler = RssSampler()
+    if sampler.start_rss is not None:
+        sampler.start()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn(*args, **kwargs)
+    wall_time = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss_peak = sampler.stop()
+    return result, {'phase': phase, 'wall_time': round(wall_time, 4), 'python_heap_peak': peak, 'rss_peak': rss_peak}
+
+# run every phase of the pipeline on the district in the current directory
+def run_pipeline(school_codes, options, bus_capacity=54, num_buses=97, max_route_time=2700):
+    records = []
+    tiers = len(school_codes)
+    schools = [(tier, school) for tier in range(1,tiers+1) for school in school_codes[tier-1]]
+    fleet = [bus_capacity for i in range(num_buses)]
+    load_school_locations.cache_clear()
+
+    stops_data, record = measure('parse', lambda: {tier: pm_new.load_tier_data(tier) for tier in range(1,tiers+1)})
+    records.append(record)
+
+    def create_all():
+        return [pm_new.create_data_model(school, 'Tier'+str(tier)+'\\'+school+'_pmDistance.csv', stops_data[tier],
+                                         fleet, max_route_time) for tier, school in schools]
+    data, record = measure('matrix', create_all)
+    records.append(record)
+
+    models, record = measure('model', lambda: [pm_new.build_model(d, options['engine'], options['neighbors'])
+                                               for d in data])
+    records.append(dict(record, variables=sum(routing.Size() for manager, routing in models)))
+    del models
+
+    search_parameters = pm_new.create_search_parameters(options['time_limit'])
+    solved, record = measure('solve', lambda: [pm_new.solve_data(d, options, search_parameters) for d in data])
+    routes = {school: build_routes(opt_routes, tier, school, stops_data[tier])
+              for (tier, school), opt_routes in zip(schools, solved)}
+    records.append(dict(record, objective=int(sum(route[1] for opt_routes in solved for route in opt_routes)),
+                        buses=sum(len(opt_routes) for opt_routes in solved)))
+
+    # the greedy engine needs a bus for every route in the worst case
+    num_buses = max(num_buses, sum(len(school_routes) for school_routes in routes.values()))
+    distances, record = measure('distances', last_stop_distances, routes, school_codes)
+    records.append(record)
+
+    for engine in CHAINING_ENGINES:
+        (bus_routes, deadhead), record = measure('chaining_' + engine, assign_buses, routes, school_codes,
+                                                 max_route_time, num_buses, engine, distances)
+        records.append(dict(record, buses=buses_in_service(bus_routes), deadhead=float(deadhead)))
+    return records
+
+# benchmark every scale, seed and set of solve options; each record is appended to
+# output as soon as it is measured and all of them are returned
+def run_benchmark(scales, seeds, option_sets, output='benchmark_results.jsonl',
+                  schools_per_tier=SCHOOLS_PER_TIER, stops_per_school=STOPS_PER_SCHOOL,
+                  students_per_stop=STUDENTS_PER_STOP):
+    school_codes = synthetic_school_codes(schools_per_tier)
+    run_at = datetime.datetime.now().isoformat(timespec='seconds')
+    results = []
+    for scale in scales:
+        for seed in seeds:
+            directory = tempfile.mkdtemp(prefix='wjcc_benchmark_')
+            try:
+                generate_district(directory, school_codes, stops_per_school, students_per_stop, scale, seed)
+                with working_directory(directory):
+                    for name, options in option_sets.items():
+                        options = dict(pm_new.SOLVE_OPTIONS, **options)
+                        for record in run_pipeline(school_codes, options):
+                            record = dict(record, run_at=run_at, scale=scale, seed=seed, options=name,
+                                          schools=sum(schools_per_tier))
+                            results.append(record)
+                            with open(output, 'a') as f:
+                                f.write(json.dumps(record) + '\n')
+                            print_record(record)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def print_record(record):
+    extra = ''.join(' {}={}'.format(key, record[key]) for key in ['variables', 'objective', 'buses', 'deadhead']
+                    if key in record)
+    rss = '{:>12,}B'.format(record['rss_peak']) if record['rss_peak'] is not None else '{:>13}'.format('-')
+    print('scale {scale:<4} seed {seed:<3} {options:<10} {phase:<18} {wall_time:>9.3f}sec '
+          'python heap {python_heap_peak:>12,}B rss '.format(**record) + rss + extra)
+
+# solve options benchmarked by default: today's settings with a short, fixed search,
+# and the same with big schools solved in clusters
+BENCHMARK_OPTIONS = {'default': {'time_limit': 10, 'cache_dir': None},
+                     'decomposed': {'time_limit': 10, 'cache_dir': None, 'max_cluster_size': 60,
+                                    'repair_time_limit': 5}}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the PM routing pipeline on synthetic districts')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 2, 5, 10],
+                        help='multipliers of the stops per school')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--schools', type=int, nargs='+', default=SCHOOLS_PER_TIER,
+                        help='number of schools in each tier')
+    parser.add_argument('--time-limit', type=int, default=10, help='seconds of search per school')
+    parser.add_argument('--neighbors', type=int, nargs='*', default=[],
+                        help='also benchmark arcs pruned to each of these numbers of nearest stops')
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    args = parser.parse_args()
+
+    option_sets = dict(BENCHMARK_OPTIONS)
+    for k in args.neighbors:
+        option_sets['knn' + str(k)] = dict(BENCHMARK_OPTIONS['default'], neighbors=k)
+    option_sets = {name: dict(options, time_limit=args.time_limit) for name, options in option_sets.items()}
+    run_benchmark(args.scales, args.seeds, option_sets, args.output, args.schools)
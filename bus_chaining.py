@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Chaining of school routes into buses across tiers.
+
+A bus drives a tier 1 route and can then deadhead from the last stop of that
+route to a tier 2 (or tier 3) school and drive one of its routes, and so on.
+Two engines decide which bus takes which route:
+
+greedy   -> the original heuristic: buses in order each take the nearest school
+            that still has routes
+matching -> every tier transition solved as a minimum-cost bipartite matching of
+            buses to routes, fewest new buses first and least deadhead second
+joint    -> one routing model of the whole district: every school route is a node
+            that must start at its tier's bell time, buses chain them across all
+            tiers at once, fewest buses first and least deadhead second
+
+All return the bus routes as {bus: [[school, route, duration], ...]} and the
+total deadhead time in seconds. With a mixed fleet a bus only chains routes of its
+own vehicle type (Route.vehicle_type), since it is the same bus in every tier. Deadhead times are deadhead_time of the geodesic
+distance, or come from a travel_time provider given to last_stop_distances.
+"""
+
+from ortools.constraint_solver import routing_enums_pb2, pywrapcp
+from ortools.graph.python import min_cost_flow
+from geodesic import school_distances, load_school_locations
+from metrics import NULL_SINK
+
+DETOUR_FACTOR = 1.536   # avg factor to convert from euclidean to google maps distance
+BUS_SPEED = 13          # about the avg velocity (m/s) of the bus when doing its route
+JOINT_TIME_LIMIT = 30   # seconds of search for the joint model of the district
+
+# time for a bus to drive from its last stop to a school dist meters away
+def deadhead_time(dist):
+    return (dist*DETOUR_FACTOR)//BUS_SPEED
+
+def which_tier(school, school_codes):
+    temp = 0
+    for t, s in enumerate(school_codes):
+        if school in s:
+            temp = t+1
+
+    return temp
+
+# distance dictionary, [tier, school, route]: tuples of (next school, distance, next_tier,
+# deadhead time) sorted by distance, computed for all last stops of a tier at once; tiers
+# are those of school_codes. provider (see travel_time.py) gives road distances and times
+# instead of the geodesic distance and deadhead_time
+def last_stop_distances(routes, school_codes, filename='school_locations.csv', provider=None):
+    school_tiers = {school: t+1 for t, schools in enumerate(school_codes) for school in schools}
+    distances = {}
+    for tier in range(1,len(school_codes)):
+        keys = []
+        coords = []
+        places = []
+        for school in school_codes[tier-1]:
+            for route in routes[school]:
+                keys.append((tier, school, route.route))
+                coords.append(route.last_stop)
+                places.append((str(route.names[-1]),) + tuple(route.last_stop))
+        if provider is None:
+            for key, dists in zip(keys, school_distances(coords, tier+1, filename, school_tiers)):
+                distances[key] = [(school, dist, next_tier, deadhead_time(dist)) for school, dist, next_tier in dists]
+        else:
+            distances.update(provider_distances(keys, places, tier+1, filename, school_tiers, provider))
+    return distances
+
+# last_stop_distances of the last stops places (id, latitude, longitude) from provider
+def provider_distances(keys, places, tier, filename, school_tiers, provider):
+    from travel_time import Place
+    schools = load_school_locations(filename)
+    candidates = [(str(school), school_tiers.get(school, int(t)), Place(str(school), float(lat), float(lon)))
+                  for school, t, lat, lon in zip(schools['school'], schools['tier'], schools['latitude'],
+                                                 schools['longitude'])]
+    candidates = [candidate for candidate in candidates if candidate[1] >= tier]
+    distances = {}
+    for key, place in zip(keys, places):
+        dists, times = provider.one_to_many(Place(*place), [candidate[2] for candidate in candidates])
+        distances[key] = sorted([(school, float(dist), next_tier, float(time // 1))
+                                 for (school, next_tier, destination), dist, time in zip(candidates, dists, times)],
+                                key=lambda entry: entry[1])
+    return distances
+
+# assign buses to tier 1 school routes, one bus per route
+def assign_first_tier(routes, school_codes, num_buses):
+    bus_routes = {i:[] for i in range(num_buses)}
+    bus_counter = 0
+    for school in school_codes[0]:
+        for route in reversed(range(len(routes[school]))):
+            bus_routes[bus_counter].append([school, route, routes[school][route].time])
+            bus_counter += 1
+    return bus_routes
+
+# highest numbered route of school still in routes_left ({school: [route]}) that a bus
+# of vehicle_type can drive, None when there is none
+def next_route_of_type(routes, routes_left, school, vehicle_type):
+    for route in reversed(routes_left.get(school, [])):
+        if routes[school][route].vehicle_type == vehicle_type:
+            return route
+    return None
+
+# assign buses to tier 2 and 3 school routes based on distances from last stops of tier 1 and 2
+def chain_greedy(routes, school_codes, distances, max_route_time, num_buses):
+    tiers = len(school_codes)
+    routes_left = {school: list(range(len(routes[school]))) for schools in school_codes for school in schools}
+    bus_routes = assign_first_tier(routes, school_codes, num_buses)
+    for school in school_codes[0]:
+        routes_left[school] = []
+
+    deadhead = 0
+    bus_counter = 0
+    for tier in range(2,tiers+1):
+        for bus, assignments in bus_routes.items():
+            if len(assignments) == 0:
+                bus_counter = bus
+                break
+
+            school = assignments[len(assignments)-1][0]
+            route = assignments[len(assignments)-1][1]
+
+            if len(assignments)==1 and tier == 2:
+                dists = [dist for dist in distances[(1, school, route)] if dist[2]==tier]
+            elif len(assignments)==1 and tier == 3:
+                dists = [dist for dist in distances[(which_tier(school, school_codes), school, route)] if dist[2]==tier]
+            else:
+                dists = distances[(2, school, route)]
+
+            vehicle_type = routes[school][route].vehicle_type
+            for i in range(len(dists)):
+                next_route = next_route_of_type(routes, routes_left, dists[i][0], vehicle_type)
+                if next_route is not None:
+                    next_school = dists[i][0]
+                    duration = dists[i][3]
+                    # check to make sure that the bus can make it to the next school on time from its last stop
+                    if bus_routes[bus][len(assignments)-1][2] + duration <= max_route_time or (which_tier(next_school, school_codes)==3 and which_tier(school, school_codes)==1):
+                        routes_left[next_school].remove(next_route)
+                        next_route_duration = routes[next_school][next_route].time
+                        bus_routes[bus][len(assignments)-1][2] += duration
+                        bus_routes[bus].append([next_school, next_route, next_route_duration])
+                        deadhead += duration
+                        break
+
+        # checks for unassigned buses and assigns them
+        for school in school_codes[tier-1]:
+            while routes_left[school]:
+                route = routes_left[school].pop()
+                bus_routes[bus_counter].append([school, route, routes[school][route].time])
+                bus_counter += 1
+
+    return bus_routes, deadhead
+
+# match buses to the schools of the next tier; arcs are (bus, school, deadhead) for every
+# bus that can reach the school on time and route_counts the routes each school has,
+# where a school can be any key, e.g. (school, vehicle type).
+# Returns {school: [(bus, deadhead), ...]} with the fewest routes left for new buses
+# and, among those, the least total deadhead
+def min_cost_matching(buses, route_counts, arcs):
+    schools = list(route_counts)
+    num_routes = sum(route_counts.values())
+    bus_node = {bus: 1+i for i, bus in enumerate(buses)}
+    school_node = {school: 1+len(buses)+i for i, school in enumerate(schools)}
+    source, new_buses, sink = 0, 1+len(buses)+len(schools), 2+len(buses)+len(schools)
+    # a new bus costs more than any set of deadheads it could save
+    new_bus_cost = int(max([arc[2] for arc in arcs] + [0]) + 1) * (num_routes + 1)
+
+    smcf = min_cost_flow.SimpleMinCostFlow()
+    for bus in buses:
+        smcf.add_arc_with_capacity_and_unit_cost(source, bus_node[bus], 1, 0)
+    matching_arcs = []
+    for bus, school, duration in arcs:
+        matching_arcs.append((smcf.add_arc_with_capacity_and_unit_cost(
+            bus_node[bus], school_node[school], 1, int(duration)), bus, school, duration))
+    smcf.add_arc_with_capacity_and_unit_cost(source, new_buses, num_routes, 0)
+    for school in schools:
+        smcf.add_arc_with_capacity_and_unit_cost(new_buses, school_node[school], route_counts[school], new_bus_cost)
+        smcf.add_arc_with_capacity_and_unit_cost(school_node[school], sink, route_counts[school], 0)
+    smcf.set_node_supply(source, num_routes)
+    smcf.set_node_supply(sink, -num_routes)
+
+    status = smcf.solve()
+    if status != smcf.OPTIMAL:
+        raise RuntimeError('Bus matching failed with status {}'.format(status))
+
+    matches = {school: [] for school in schools}
+    for arc, bus, school, duration in matching_arcs:
+        if smcf.flow(arc) > 0:
+            matches[school].append((bus, duration))
+    return matches
+
+# assign buses to tier 2 and 3 school routes as a minimum-cost matching per tier,
+# only allowing the buses that can make it to the next school on time
+def chain_matching(routes, school_codes, distances, max_route_time, num_buses):
+    tiers = len(school_codes)
+    bus_routes = assign_first_tier(routes, school_codes, num_buses)
+
+    deadhead = 0
+    for tier in range(2,tiers+1):
+        buses = [bus for bus, assignments in bus_routes.items() if assignments]
+        # routes of each school by the type of bus that drives them
+        groups = {}
+        for school in school_codes[tier-1]:
+            for route in range(len(routes[school])):
+                groups.setdefault((school, routes[school][route].vehicle_type), []).append(route)
+        route_counts = {group: len(group_routes) for group, group_routes in groups.items()}
+        arcs = []
+        for bus in buses:
+            school, route, duration = bus_routes[bus][-1]
+            last_tier = which_tier(school, school_codes)
+            vehicle_type = routes[school][route].vehicle_type
+            for next_school, dist, next_tier, travel in distances[(last_tier, school, route)]:
+                if route_counts.get((next_school, vehicle_type), 0) == 0:
+                    continue
+                if duration + travel <= max_route_time or (tier == 3 and last_tier == 1):
+                    arcs.append((bus, (next_school, vehicle_type), travel))
+
+        matches = min_cost_matching(buses, route_counts, arcs)
+        bus_counter = len(buses)
+        for (school, vehicle_type), group_routes in groups.items():
+            for bus, travel in sorted(matches[(school, vehicle_type)]):
+                next_route = group_routes.pop()
+                bus_routes[bus][-1][2] += travel
+                bus_routes[bus].append([school, next_route, routes[school][next_route].time])
+                deadhead += travel
+            # the routes no bus could reach get a new bus
+            while group_routes:
+                next_route = group_routes.pop()
+                bus_routes.setdefault(bus_counter, []).append([school, next_route, routes[school][next_route].time])
+                bus_counter += 1
+
+    return bus_routes, deadhead
+
+# start time of each tier's routes; by default tiers are max_route_time apart, so a
+# route and the deadhead after it must fit in max_route_time as with the other engines
+def default_bell_times(tiers, max_route_time):
+    return [t*max_route_time for t in range(tiers)]
+
+# chain the routes of all tiers into buses with one routing model. Every route is a
+# node whose Time cumul is the time its bus leaves the school, which must be within
+# bell_slack seconds after its tier's bell time; the transit of a node is its route
+# time plus the deadhead to the next school. Each bus has a fixed cost larger than all
+# deadhead, so the search minimizes buses first and deadhead second. The search
+# starts from the matching engine's plan when that plan keeps to the bell times, and
+# then never needs more buses than matching. Matching lets a tier 1 bus skip to tier 3
+# without checking the bell times, so its plan can break them; the search then starts
+# from scratch and may need more buses than matching did
+def chain_joint(routes, school_codes, distances, max_route_time, num_buses, bell_times=None, bell_slack=0,
+                time_limit=JOINT_TIME_LIMIT):
+    if bell_times is None:
+        bell_times = default_bell_times(len(school_codes), max_route_time)
+    # node 0 is where buses come from and go to, nodes 1.. are the routes
+    blocks = [(school, route.route, which_tier(school, school_codes), route.time)
+              for schools in school_codes for school in schools for route in routes[school]]
+    if not blocks:
+        return {i:[] for i in range(num_buses)}, 0
+    node_of = {(school, route): node for node, (school, route, tier, duration) in enumerate(blocks, 1)}
+    num_nodes = len(blocks)+1
+    horizon = max(bell_times) + bell_slack + max_route_time
+
+    time_matrix = [[0 for j in range(num_nodes)] for i in range(num_nodes)]
+    deadhead_matrix = [[0 for j in range(num_nodes)] for i in range(num_nodes)]
+    allowed = {}
+    for node, (school, route, tier, duration) in enumerate(blocks, 1):
+        time_matrix[node] = [duration for j in range(num_nodes)]
+        allowed[node] = []
+        for next_school, dist, next_tier, travel in distances.get((tier, school, route), []):
+            # the bus must be at the next school by its bell time
+            if bell_times[tier-1] + duration + travel > bell_times[next_tier-1] + bell_slack:
+                continue
+            for next_route in routes.get(next_school, []):
+                # a bus drives routes of its own vehicle type only
+                if next_route.vehicle_type != routes[school][route].vehicle_type:
+                    continue
+                next_node = node_of[(next_school, next_route.route)]
+                time_matrix[node][next_node] = int(duration + travel)
+                deadhead_matrix[node][next_node] = int(travel)
+                allowed[node].append(next_node)
+
+    manager = pywrapcp.RoutingIndexManager(num_nodes, len(blocks), 0)
+    routing = pywrapcp.RoutingModel(manager)
+    time_callback_index = routing.RegisterTransitMatrix(time_matrix)
+    deadhead_callback_index = routing.RegisterTransitMatrix(deadhead_matrix)
+    routing.SetArcCostEvaluatorOfAllVehicles(deadhead_callback_index)
+    # a bus costs more than any deadhead it could save
+    routing.SetFixedCostOfAllVehicles(sum(max(row) for row in deadhead_matrix) + 1)
+    routing.AddDimension(
+        time_callback_index,
+        horizon,  # buses may wait at a school for its bell
+        horizon,
+        False,    # buses may come in at any time
+        'Time')
+    time_dimension = routing.GetDimensionOrDie('Time')
+    ends = [routing.End(vehicle) for vehicle in range(routing.vehicles())]
+    for node, (school, route, tier, duration) in enumerate(blocks, 1):
+        index = manager.NodeToIndex(node)
+        time_dimension.CumulVar(index).SetRange(bell_times[tier-1], bell_times[tier-1] + bell_slack)
+        routing.NextVar(index).SetValues([manager.NodeToIndex(next_node) for next_node in allowed[node]] + ends)
+
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.time_limit.seconds = time_limit
+    search_parameters.first_solution_strategy = (
+        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    routing.CloseModelWithParameters(search_parameters)
+
+    # start from the matching plan when it keeps to the bell times
+    matched, matched_deadhead = chain_matching(routes, school_codes, distances, max_route_time, num_buses)
+    initial_solution = routing.ReadAssignmentFromRoutes(
+        [[manager.NodeToIndex(node_of[(school, route)]) for school, route, duration in assignments]
+         for assignments in matched.values() if assignments], True)
+    if initial_solution is not None:
+        solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
+    else:
+        print('The matching plan ({} buses) breaks the bell times, the joint model starts from scratch'.format(
+            buses_in_service(matched)))
+        solution = routing.SolveWithParameters(search_parameters)
+    if solution is None:
+        print('Joint model found no plan (status {}), using the matching plan'.format(routing.status()))
+        return matched, matched_deadhead
+
+    chains = []
+    for vehicle in range(routing.vehicles()):
+        index = solution.Value(routing.NextVar(routing.Start(vehicle)))
+        chain = []
+        while not routing.IsEnd(index):
+            chain.append(manager.IndexToNode(index))
+            index = solution.Value(routing.NextVar(index))
+        if chain:
+            chains.append(chain)
+    # number the buses in the order of the routes they start with
+    chains.sort()
+
+    bus_routes = {i:[] for i in range(max(num_buses, len(chains)))}
+    deadhead = 0
+    for bus, chain in enumerate(chains):
+        for i, node in enumerate(chain):
+            school, route, tier, duration = blocks[node-1]
+            travel = deadhead_matrix[node][chain[i+1]] if i+1 < len(chain) else 0
+            bus_routes[bus].append([school, route, duration + travel])
+            deadhead += travel
+    return bus_routes, float(deadhead)
+
+CHAINING_ENGINES = {'greedy': chain_greedy,
+                    'matching': chain_matching,
+                    'joint': chain_joint}
+
+# chain the routes of every school into buses with the named engine; bell_times (the
+# start of each tier's routes in seconds) are kept by the joint engine, the others
+# chain tiers max_route_time apart
+def assign_buses(routes, school_codes, max_route_time, num_buses, engine='matching', distances=None,
+                 provider=None, bell_times=None):
+    if distances is None:
+        distances = last_stop_distances(routes, school_codes, provider=provider)
+    if engine == 'joint':
+        return chain_joint(routes, school_codes, distances, max_route_time, num_buses, bell_times)
+    return CHAINING_ENGINES[engine](routes, school_codes, distances, max_route_time, num_buses)
+
+# buses in service in an assignment
+def buses_in_service(bus_routes):
+    return sum(1 for assignments in bus_routes.values() if assignments)
+
+# run every engine on the same routes and report buses used and deadhead of each;
+# returns {engine: (bus_routes, deadhead)}; each phase is timed into metrics
+def compare_chaining(routes, school_codes, max_route_time, num_buses, metrics=NULL_SINK, provider=None,
+                     bell_times=None):
+    with metrics.phase('distances'):
+        distances = last_stop_distances(routes, school_codes, provider=provider)
+    results = {}
+    for engine in CHAINING_ENGINES:
+        with metrics.phase('chaining', engine=engine) as fields:
+            bus_routes, deadhead = assign_buses(routes, school_codes, max_route_time, num_buses, engine, distances,
+                                                bell_times=bell_times)
+            fields.update(buses=buses_in_service(bus_routes), deadhead=deadhead)
+        print('Chaining ({}): {} buses, {}sec of deadhead'.format(engine, buses_in_service(bus_routes), deadhead))
+        results[engine] = (bus_routes, deadhead)
+    return results
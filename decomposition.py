@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial decomposition of schools with many stops.
+
+The stops of a school are clustered by location with k-means, into clusters of at
+most max_cluster_size stops, and every cluster is solved as its own CVRP with the
+school as depot, in parallel when workers > 1. Routes then never cross a cluster
+boundary, so neighbouring clusters are repaired in pairs: the routes touching both
+clusters are solved again together, starting from the current routes, and the
+result is kept only when it is not worse.
+"""
+
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# k-means of points (rows of coordinates); labels of the points and the centres
+def kmeans(points, k, seed=0, iterations=100):
+    rng = np.random.default_rng(seed)
+    centres = points[rng.choice(len(points), k, replace=False)]
+    for i in range(iterations):
+        labels = np.argmin(((points[:, np.newaxis, :] - centres[np.newaxis, :, :])**2).sum(axis=2), axis=1)
+        moved = np.array([points[labels == c].mean(axis=0) if np.any(labels == c) else centres[c]
+                          for c in range(k)])
+        if np.allclose(moved, centres):
+            break
+        centres = moved
+    return labels, centres
+
+# clusters of the stops (nodes 1..) of a school, none with more than max_cluster_size
+# stops; longitude is scaled so that both axes are about the same distance per degree
+def cluster_stops(latitude, longitude, max_cluster_size, seed=0):
+    points = np.column_stack([latitude, longitude * np.cos(np.radians(np.mean(latitude)))])
+    clusters = []
+    pending = [np.arange(1, len(points))]
+    while pending:
+        nodes = pending.pop()
+        if len(nodes) <= max_cluster_size:
+            clusters.append(nodes)
+            continue
+        k = int(np.ceil(len(nodes) / max_cluster_size))
+        labels, centres = kmeans(points[nodes], k, seed)
+        parts = [nodes[labels == c] for c in range(k) if np.any(labels == c)]
+        if len(parts) == 1:
+            # identical locations: split them in order
+            parts = np.array_split(nodes, k)
+        pending.extend(parts)
+    clusters.sort(key=lambda nodes: nodes[0])
+    return clusters
+
+# data model of the school restricted to nodes; the school and the dummy end stay
+# the first and last node. Also returns the school node of every sub-problem node
+def sub_data(data, nodes):
+    end = len(data['time_matrix'])-1
+    index = np.concatenate([[0], np.sort(nodes), [end]]).astype(int)
+    sub = dict(data)
+    sub['students'] = [data['students'][node] for node in index[:-1]]
+    sub['stop_names'] = np.asarray(data['stop_names'])[index[:-1]]
+    sub['distance_matrix'] = np.asarray(data['distance_matrix'])[np.ix_(index[1:-1]-1, index[1:-1]-1)]
+    sub['time_matrix'] = np.asarray(data['time_matrix'])[np.ix_(index, index)]
+    sub['ends'] = [len(index)-1 for i in range(data['num_vehicles'])]
+    for key in ['latitude', 'longitude']:
+        if key in data:
+            sub[key] = np.asarray(data[key])[index[:-1]]
+    return sub, index
+
+# routes of a sub-problem in the nodes of the school
+def to_school_nodes(opt_routes, index):
+    return [[[(int(index[node]), students) for node, students in route], route_time, route_load]
+            for route, route_time, route_load in opt_routes]
+
+def total_time(opt_routes):
+    return sum(route[1] for route in opt_routes)
+
+# pairs of clusters whose centres are nearest to each other
+def neighbouring_clusters(data, clusters):
+    centres = np.array([[np.mean(data['latitude'][nodes]), np.mean(data['longitude'][nodes])] for nodes in clusters])
+    pairs = set()
+    for c in range(len(clusters)):
+        dists = ((centres - centres[c])**2).sum(axis=1)
+        dists[c] = np.inf
+        pairs.add(tuple(sorted((c, int(np.argmin(dists))))))
+    return sorted(pairs)
+
+# previous routes (stop names per route) cut down to the stops of a sub-problem;
+# None when none of its stops were on a previous route
+def cluster_routes(previous_routes, sub):
+    if previous_routes is None:
+        return None
+    names = set(str(name) for name in sub['stop_names'][1:])
+    routes = [[name for name in route if str(name) in names] for route in previous_routes]
+    routes = [route for route in routes if route]
+    return routes or None
+
+# solve every cluster with solve(data, options, search_parameters) (pm_new.main), then
+# repair neighbouring clusters with solve(..., previous_routes) for repair_time_limit
+# seconds each. previous_routes (stop names per route) of the whole school warm-start
+# each cluster with its part of them. Returns the routes in the school's nodes like solve does
+def solve_decomposed(data, solve, options, search_parameters, max_cluster_size, workers=1,
+                     repair_time_limit=10, seed=0, previous_routes=None):
+    clusters = cluster_stops(data['latitude'], data['longitude'], max_cluster_size, seed)
+    subs = [sub_data(data, nodes) for nodes in clusters]
+    print('Decomposed {} stops into {} clusters of at most {}'.format(
+        len(data['students'])-1, len(clusters), max_cluster_size))
+    warm_starts = [cluster_routes(previous_routes, sub) for sub, index in subs]
+
+    # a target objective is for the whole school, not for a cluster of it
+    options = dict(options or {}, target_objective=None)
+    if workers <= 1:
+        solved = [solve(sub, options, search_parameters, warm_start)
+                  for (sub, index), warm_start in zip(subs, warm_starts)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            solved = list(executor.map(solve, [sub for sub, index in subs],
+                                       [dict(options, cancel=None) for sub in subs],
+                                       [search_parameters for sub in subs], warm_starts))
+    routes = [route for (sub, index), opt_routes in zip(subs, solved)
+              for route in to_school_nodes(opt_routes, index)]
+    if len(clusters) < 2 or repair_time_limit is None:
+        return routes
+
+    repair_parameters = type(search_parameters)()
+    repair_parameters.CopyFrom(search_parameters)
+    repair_parameters.time_limit.seconds = repair_time_limit
+    cluster_of = {int(node): c for c, nodes in enumerate(clusters) for node in nodes}
+    end = len(data['time_matrix'])-1
+    for pair in neighbouring_clusters(data, clusters):
+        touching = [route for route in routes
+                    if any(cluster_of.get(node) in pair for node, students in route[0])]
+        nodes = np.array([node for route in touching for node, students in route[0] if 0 < node < end])
+        sub, index = sub_data(data, nodes)
+        previous_routes = [[str(data['stop_names'][node]) for node, students in route[0] if 0 < node < end]
+                           for route in touching]
+        repaired = to_school_nodes(solve(sub, options, repair_parameters, previous_routes), index)
+        if repaired and total_time(repaired) <= total_time(touching):
+            routes = [route for route in routes if route not in touching] + repaired
+    return routes
+
+# solve the school whole and decomposed and report how long each took and how good
+# its routes are
+def compare_decomposition(data, solve, options, search_parameters, max_cluster_size, workers=1,
+                          repair_time_limit=10):
+    results = {}
+    start_time = time.time()
+    opt_routes = solve(data, options, search_parameters)
+    results['monolithic'] = {'buses': len(opt_routes), 'route_time': total_time(opt_routes),
+                             'wall_time': time.time() - start_time}
+    start_time = time.time()
+    opt_routes = solve_decomposed(data, solve, options, search_parameters, max_cluster_size, workers,
+                                  repair_time_limit)
+    results['decomposed'] = {'buses': len(opt_routes), 'route_time': total_time(opt_routes),
+                             'wall_time': time.time() - start_time}
+    for mode, result in results.items():
+        print('{}: {buses} buses, {route_time}sec of routes in {wall_time:.1f}sec'.format(mode, **result))
+    return results
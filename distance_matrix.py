@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Loading and shaping of the per-school stop-to-stop matrices.
+
+Each Tier*\\SCHOOL_pmDistance.csv holds one quoted "(dist,time)" tuple per cell.
+The whole file is parsed in one pass into integer NumPy planes, and the solver's
+time matrix (depot row/column, dummy end node, dwell time at each stop) is built
+with array operations instead of nested Python lists.
+
+The text files can be converted once into a binary store, Tier*\\SCHOOL_pmMatrix.npy,
+holding int32 distance and time planes, next to Tier*\\SCHOOL_pmMatrix_ids.npy with
+the stop name of every row. The store is read through a memory map, so only the
+rows of the stops a model needs are ever read from disk. A store older than its
+text file, or without a stop that is asked for, is converted again from the text.
+
+    python distance_matrix.py    converts the matrices of every school in Tier1-3
+"""
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+# characters that separate the numbers of a "(dist,time)" cell
+_CELL_SEPARATORS = str.maketrans('"(),', '    ')
+
+# read a SCHOOL_pmDistance.csv file into (distance, time) integer matrices
+def load_matrix_planes(filename):
+    with open(filename, 'r') as f:
+        text = f.read()
+
+    values = np.fromstring(text.translate(_CELL_SEPARATORS), dtype=np.int64, sep=' ')
+    num_stops = int(round(np.sqrt(values.size / 2)))
+    if values.size != num_stops * num_stops * 2:
+        raise ValueError('{} is not a square matrix of (dist,time) cells'.format(filename))
+
+    planes = values.reshape(num_stops, num_stops, 2)
+    return planes[:, :, 0], planes[:, :, 1]
+
+# time spent at each stop picking up its students
+# stops with 5 or less take a minute, after that its 10 seconds a kid
+# (the extra time keeps the original "students - 5*10" arithmetic)
+def dwell_times(students):
+    students = np.asarray(students, dtype=np.int64)
+    return np.where(students <= 5, 60, 60 + (students - 5 * 10))
+
+# add the school as depot in the 0th row and col, the dummy end stop as the
+# last row and col, and the time spent at each stop picking up students
+def build_time_matrix(depot_times, time_plane, students):
+    num_stops = len(time_plane)
+    time_matrix = np.zeros((num_stops+2, num_stops+2), dtype=np.int64)
+    time_matrix[0, :num_stops+1] = depot_times
+    time_matrix[1:num_stops+1, 0] = depot_times[1:]
+    time_matrix[1:num_stops+1, 1:num_stops+1] = time_plane
+
+    stops = time_matrix[1:num_stops+1, 1:num_stops+1]
+    stops += dwell_times(students[1:num_stops+1])[np.newaxis, :]
+    np.fill_diagonal(stops, time_plane.diagonal())
+    return time_matrix
+
+# the stop to stop time plane a time matrix was built from
+def time_plane_of(time_matrix, students):
+    num_stops = len(time_matrix)-2
+    time_plane = np.array(time_matrix[1:num_stops+1, 1:num_stops+1], dtype=np.int64)
+    diagonal = time_plane.diagonal().copy()
+    time_plane -= dwell_times(students[1:num_stops+1])[np.newaxis, :]
+    np.fill_diagonal(time_plane, diagonal)
+    return time_plane
+
+# names of the binary store that belongs to a SCHOOL_pmDistance.csv file
+def matrix_store_paths(filename):
+    base = filename[:-len('_pmDistance.csv')] if filename.endswith('_pmDistance.csv') else os.path.splitext(filename)[0]
+    return base + '_pmMatrix.npy', base + '_pmMatrix_ids.npy'
+
+# convert a SCHOOL_pmDistance.csv file into the binary store; stop_ids names the
+# stop of each row of the matrix, in the same order
+def convert_matrix(filename, stop_ids):
+    distance_plane, time_plane = load_matrix_planes(filename)
+    if len(stop_ids) != len(time_plane):
+        raise ValueError('{} has {} rows but {} stop ids were given'.format(filename, len(time_plane), len(stop_ids)))
+    write_matrix_store(filename, distance_plane, time_plane, stop_ids)
+
+# write the binary store of filename; each file is written under a temporary name and
+# then renamed, so processes reading the old store meanwhile never see half a file
+def write_matrix_store(filename, distance_plane, time_plane, stop_ids):
+    matrix_path, ids_path = matrix_store_paths(filename)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(matrix_path) or '.', suffix='.npy')
+    os.close(fd)
+    planes = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int32,
+                                       shape=(2, len(time_plane), len(time_plane)))
+    planes[0] = distance_plane
+    planes[1] = time_plane
+    planes.flush()
+    del planes
+    os.replace(tmp_path, matrix_path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(ids_path) or '.', suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, np.array([str(stop) for stop in stop_ids]))
+    os.replace(tmp_path, ids_path)
+
+# convert the matrices of every school of a tier, naming rows by the stops in Tier*_pm.csv
+def convert_tier(tier):
+    stops_data = pd.read_csv('Tier'+str(tier)+'\\'+'Tier'+str(tier)+'_pm.csv', delimiter=',').values
+    for school in pd.unique(stops_data[:, 4]):
+        filename = 'Tier'+str(tier)+'\\'+school+'_pmDistance.csv'
+        if os.path.isfile(filename):
+            # the first row of a school in Tier*_pm.csv is the school itself
+            convert_matrix(filename, stops_data[stops_data[:, 4] == school][1:, 5])
+            print('Converted ' + filename)
+
+# memory-mapped (distance, time) planes and stop ids of a binary store
+def open_matrix_store(filename):
+    matrix_path, ids_path = matrix_store_paths(filename)
+    planes = np.load(matrix_path, mmap_mode='r')
+    stop_ids = np.load(ids_path)
+    return planes[0], planes[1], stop_ids
+
+# whether the SCHOOL_pmDistance.csv file was written after its binary store
+def store_is_stale(filename):
+    matrix_path, ids_path = matrix_store_paths(filename)
+    if not os.path.isfile(ids_path):
+        return True
+    if not os.path.isfile(filename):
+        return False
+    return os.path.getmtime(filename) > min(os.path.getmtime(matrix_path), os.path.getmtime(ids_path))
+
+# parse the SCHOOL_pmDistance.csv file, and write its binary store again when stop_ids
+# name its rows; a store that cannot be written is only a slower next run
+def reconvert_matrix(filename, stop_ids):
+    distance_plane, time_plane = load_matrix_planes(filename)
+    if stop_ids is not None and len(stop_ids) == len(time_plane):
+        try:
+            write_matrix_store(filename, distance_plane, time_plane, stop_ids)
+        except (IOError, OSError) as error:
+            print('Could not convert {} again: {}'.format(filename, error))
+    return distance_plane, time_plane
+
+# (distance, time) planes for the given stops, in their order; read from the binary
+# store when there is one, otherwise parsed from the SCHOOL_pmDistance.csv file,
+# whose rows must then be the stops in order. A store older than the csv file, or
+# missing one of the stops, is converted again from the csv file
+def load_school_matrix(filename, stop_ids=None):
+    matrix_path, ids_path = matrix_store_paths(filename)
+    if not os.path.isfile(matrix_path):
+        return load_matrix_planes(filename)
+    if store_is_stale(filename):
+        print('{} changed since it was converted, converting it again'.format(filename))
+        return reconvert_matrix(filename, stop_ids)
+
+    distance_plane, time_plane, store_ids = open_matrix_store(filename)
+    if stop_ids is None:
+        return distance_plane, time_plane
+    stop_ids = np.array([str(stop) for stop in stop_ids])
+    if np.array_equal(stop_ids, store_ids):
+        return distance_plane, time_plane
+
+    # only the rows and columns of the requested stops are read
+    row_of = {stop: row for row, stop in enumerate(store_ids)}
+    missing = [str(stop) for stop in stop_ids if stop not in row_of]
+    if missing:
+        if not os.path.isfile(filename):
+            raise KeyError('{} has no rows for stops {}'.format(matrix_path, missing))
+        print('{} has no rows for stops {}, converting {} again'.format(matrix_path, missing, filename))
+        return reconvert_matrix(filename, stop_ids)
+    rows = np.array([row_of[stop] for stop in stop_ids], dtype=np.intp)
+    return distance_plane[np.ix_(rows, rows)], time_plane[np.ix_(rows, rows)]
+
+if __name__ == '__main__':
+    for tier in range(1, 4):
+        convert_tier(tier)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Library interface to the PM routing pipeline.
+
+    from engine import Engine, EngineConfig
+    engine = Engine(EngineConfig(school_codes=[['JHS', 'LHS', 'WHS', 'TMS'], ...], data_dir='wjcc'))
+    tiers = [engine.solve_tier(tier) for tier in range(1, 4)]
+    plan = engine.assign_buses(tiers)
+    print(plan.buses, plan.deadhead)
+
+An Engine keeps everything it needs on itself: its config, the tier tables it has
+read and the matrices handed to it, so several engines (plans) can live in one
+process. Files are read from config.data_dir, never from the working directory.
+One engine can be called from several threads; the tier tables are read once under
+a lock. The solver holds the GIL while it searches, so solve_tier solves its schools
+on config.workers processes, as pm_new.solve_schools does, and hands each of them
+the school's rows, fleet and matrix from the engine.
+
+With config.travel_times (see travel_time.open_provider) deadhead times come from
+that provider, and schools without a matrix file get their matrix from it.
+
+ortools, numpy and pandas are only imported on the first call that needs them, so
+importing this module is cheap.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+@dataclass
+class EngineConfig:
+    school_codes: list                  # school codes of each tier
+    data_dir: str = ''                  # folder with the Tier* folders and school_locations.csv
+    num_buses: int = 97
+    bus_capacity: int = 54
+    max_route_time: int = 2700          # seconds
+    vehicle_types: list = None          # mixed fleet, see fleet.py; None for num_buses of bus_capacity
+    chaining: str = 'matching'          # engine of bus_chaining.CHAINING_ENGINES
+    bell_times: list = None             # seconds at which each tier's routes start, for the joint engine
+    workers: int = 1                    # worker processes solving the schools of a tier at once
+    travel_times: str = None            # travel time provider, e.g. 'road:roads.csv'; None for the estimate
+    travel_time_cache: str = 'travel_times.sqlite'  # pairs asked of the provider, None to not keep them
+    options: dict = field(default_factory=dict)  # overrides of pm_new.SOLVE_OPTIONS
+
+@dataclass
+class SchoolResult:
+    school: str
+    tier: int
+    routes: list                        # route_store.Route of every route
+    wall_time: float
+
+    @property
+    def buses(self):
+        return len(self.routes)
+
+    @property
+    def route_time(self):
+        return sum(route.time for route in self.routes)
+
+@dataclass
+class TierResult:
+    tier: int
+    schools: dict                       # {school: SchoolResult}
+
+    @property
+    def buses(self):
+        return sum(result.buses for result in self.schools.values())
+
+    @property
+    def route_time(self):
+        return sum(result.route_time for result in self.schools.values())
+
+@dataclass
+class BusPlan:
+    chaining: str
+    bus_routes: dict                    # {bus: [[school, route, duration], ...]}
+    deadhead: float
+    routes: dict = field(repr=False)    # {school: [route_store.Route]}
+
+    @property
+    def buses(self):
+        return sum(1 for assignments in self.bus_routes.values() if assignments)
+
+    # rows of bus_assignments.csv: bus, school, route, duration, load, type of the bus
+    def assignments(self):
+        return [[bus, school, route, duration, self.routes[school][route].load,
+                 self.routes[school][route].vehicle_type]
+                for bus, bus_assignments in self.bus_routes.items()
+                for school, route, duration in bus_assignments]
+
+# pm_new.solve_school, and the seconds it took; runs in a worker process with workers > 1
+def solve_timed(*args):
+    import pm_new
+    start_time = time.time()
+    opt_routes = pm_new.solve_school(*args)
+    return opt_routes, time.time() - start_time
+
+class Engine:
+    # stops_data ({tier: rows of Tier*_pm.csv}) and matrices ({school: (distance, time)
+    # planes}) can be handed in instead of being read from config.data_dir
+    def __init__(self, config, stops_data=None, matrices=None):
+        self.config = config
+        self._stops_data = dict(stops_data or {})
+        self._matrices = dict(matrices or {})
+        self._quotas = None
+        self._provider = None
+        self._lock = threading.RLock()
+
+    def _path(self, *parts):
+        return os.path.join(self.config.data_dir, '\\'.join(parts))
+
+    def tier_of(self, school):
+        for tier, schools in enumerate(self.config.school_codes, 1):
+            if school in schools:
+                return tier
+        raise KeyError('{} is in no tier of the config'.format(school))
+
+    # rows of Tier*_pm.csv for tier, read the first time they are needed
+    def stops(self, tier):
+        with self._lock:
+            if tier not in self._stops_data:
+                import pm_new
+                self._stops_data[tier] = pm_new.load_tier_data(tier, self.config.data_dir)
+            return self._stops_data[tier]
+
+    # travel time provider of config.travel_times, opened the first time it is needed;
+    # its file and cache are in config.data_dir
+    def provider(self):
+        if self.config.travel_times is None:
+            return None
+        with self._lock:
+            if self._provider is None:
+                from travel_time import open_provider
+                kind, _, filename = self.config.travel_times.partition(':')
+                cache_file = self.config.travel_time_cache
+                self._provider = open_provider(kind + (':' + self._path(filename) if filename else ''),
+                                               None if cache_file is None else self._path(cache_file))
+            return self._provider
+
+    # (distance, time) planes of school handed to the engine, or built by the provider
+    # when the school has no matrix file; None to read the file
+    def matrix(self, school, tier, stops_data):
+        if school in self._matrices or self.provider() is None:
+            return self._matrices.get(school)
+        from distance_matrix import matrix_store_paths
+        from travel_time import build_planes
+        filename = self._path('Tier'+str(tier), school+'_pmDistance.csv')
+        if os.path.isfile(filename) or os.path.isfile(matrix_store_paths(filename)[0]):
+            return None
+        with self._lock:
+            if school not in self._matrices:
+                self._matrices[school] = build_planes(self.provider(), stops_data[stops_data[:, 4] == school])
+            return self._matrices[school]
+
+    def students(self, school):
+        stops_data = self.stops(self.tier_of(school))
+        return int(-stops_data[stops_data[:, 4] == school][:, 7].sum())
+
+    # vehicle capacities and fixed costs of the buses school may use
+    def fleet(self, school):
+        config = self.config
+        if config.vehicle_types is None:
+            return [config.bus_capacity for i in range(config.num_buses)], None
+        from fleet import plan_quotas, quota_fleet
+        with self._lock:
+            if self._quotas is None:
+                school_students = {name: self.students(name) for schools in config.school_codes for name in schools}
+                self._quotas = plan_quotas(config.vehicle_types, config.school_codes, school_students)
+            return quota_fleet(config.vehicle_types, self._quotas[school], self.tier_of(school))
+
+    # arguments of pm_new.solve_school for school
+    def _school_args(self, school, time_limit=None):
+        import pm_new
+        tier = self.tier_of(school)
+        stops_data = self.stops(tier)
+        vehicle_capacities, vehicle_costs = self.fleet(school)
+        options = dict(pm_new.SOLVE_OPTIONS, **self.config.options)
+        return (tier, school, stops_data, vehicle_capacities, self.config.max_route_time, options, time_limit,
+                vehicle_costs, self.config.data_dir, self.matrix(school, tier, stops_data))
+
+    # SchoolResult of a school's solution; with a mixed fleet each route gets the type
+    # of bus it takes out of the school's quota
+    def _result(self, school, opt_routes, wall_time):
+        from route_store import build_routes
+        tier = self.tier_of(school)
+        routes = build_routes(opt_routes, tier, school, self.stops(tier))
+        if self.config.vehicle_types is not None:
+            from fleet import type_routes
+            with self._lock:
+                type_routes(routes, self.config.vehicle_types, self._quotas[school], tier)
+        return SchoolResult(school, tier, routes, wall_time)
+
+    def solve_school(self, school, time_limit=None):
+        return self._result(school, *solve_timed(*self._school_args(school, time_limit)))
+
+    def solve_tier(self, tier):
+        schools = self.config.school_codes[tier-1]
+        if self.config.workers <= 1:
+            results = [self.solve_school(school) for school in schools]
+        else:
+            args = [self._school_args(school) for school in schools]
+            # an Event cannot be sent to another process
+            args = [arg[:5] + (dict(arg[5], cancel=None),) + arg[6:] for arg in args]
+            with ProcessPoolExecutor(max_workers=self.config.workers) as executor:
+                solved = list(executor.map(solve_timed, *zip(*args)))
+            results = [self._result(school, *result) for school, result in zip(schools, solved)]
+        if self.config.vehicle_types is not None:
+            results = self.solve_short_schools(tier, results)
+        return TierResult(tier, {result.school: result for result in results})
+
+    # solve again, one at a time, the schools of tier that found no routes with their
+    # share of a mixed fleet, each with every bus the other schools of the tier left
+    # unused; raises when a school still finds no routes
+    def solve_short_schools(self, tier, results):
+        from fleet import unused_buses
+        results = list(results)
+        for i, result in enumerate(results):
+            if result.routes or self.students(result.school) <= 0:
+                continue
+            loads = {other.school: [route.load for route in other.routes] for other in results
+                     if other.school != result.school and other.routes}
+            with self._lock:
+                self._quotas[result.school] = unused_buses(self.config.vehicle_types, self._quotas, loads, tier)
+            if self.fleet(result.school)[0]:
+                results[i] = self.solve_school(result.school)
+            if not results[i].routes:
+                raise RuntimeError('{} found no routes with the {} buses left in tier {}'.format(
+                    result.school, len(self.fleet(result.school)[0]), tier))
+        return results
+
+    # chain the routes of solved tiers (TierResult or SchoolResult) into buses
+    def assign_buses(self, results, chaining=None):
+        from bus_chaining import assign_buses, last_stop_distances
+        chaining = chaining or self.config.chaining
+        routes = {}
+        for result in results:
+            for school_result in (result.schools.values() if isinstance(result, TierResult) else [result]):
+                routes[school_result.school] = school_result.routes
+        num_buses = self.config.num_buses
+        if self.config.vehicle_types is not None:
+            num_buses = sum(vehicle_type['count'] for vehicle_type in self.config.vehicle_types)
+        distances = last_stop_distances(routes, self.config.school_codes, self._path('school_locations.csv'),
+                                        self.provider())
+        bus_routes, deadhead = assign_buses(routes, self.config.school_codes, self.config.max_route_time, num_buses,
+                                            chaining, distances, bell_times=self.config.bell_times)
+        return BusPlan(chaining, bus_routes, deadhead, routes)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Sizing of the fleet handed to the routing model for one school.
+
+Modelling every available bus for every school makes the RoutingModel carry a
+start/end node and vehicle variables for buses that never leave the school.
+A school is first solved with a fleet just large enough for its students plus a
+slack margin, and the fleet only grows when the solver finds no solution with it.
+
+A fleet can also mix vehicle types, each with a capacity (one number, or one per
+tier since elementary students fit more to a bus), a count and a fixed cost per bus
+sent out. The vehicles of every type are shared out among the schools of a tier in
+proportion to their students, so the schools of a tier never use more buses of a
+type than there are while still being solved independently. Shares are only a first
+guess: a school that finds no routes with its share is solved again, one school at a
+time, with every bus the other schools of its tier left unused.
+"""
+
+import math
+import pandas as pd
+
+# extra buses on top of the seats needed, as a fraction of the buses needed
+FLEET_SLACK = 0.5
+# extra buses for schools so small that the fraction rounds to nothing
+MIN_FLEET_SLACK = 2
+
+# tight upper bound on the buses needed to carry every student of a school, when
+# buses are taken in the order of vehicle_capacities
+def fleet_upper_bound(students, vehicle_capacities, slack=FLEET_SLACK, min_slack=MIN_FLEET_SLACK):
+    total = sum(students)
+    seats = 0
+    needed = 0
+    for capacity in vehicle_capacities:
+        if seats >= total:
+            break
+        seats += capacity
+        needed += 1
+    if seats < total:
+        needed += int(math.ceil((total - seats) / float(max(vehicle_capacities))))
+    return needed + max(min_slack, int(math.ceil(needed * slack)))
+
+# fleet size for the next attempt after the solver found none with num_vehicles buses
+def grow_fleet(num_vehicles, fleet_size):
+    return min(2 * num_vehicles, fleet_size)
+
+# vehicle types from a csv with columns type, count, cost and capacity, or one
+# capacity column per tier (tier1, tier2, ...)
+def load_vehicle_types(filename='vehicle_types.csv'):
+    table = pd.read_csv(filename, delimiter=',')
+    tier_columns = sorted([column for column in table.columns if column.startswith('tier')],
+                          key=lambda column: int(column[4:]))
+    vehicle_types = []
+    for row in table.to_dict('records'):
+        capacity = [int(row[column]) for column in tier_columns] if tier_columns else int(row['capacity'])
+        vehicle_types.append({'type': str(row['type']), 'count': int(row['count']), 'cost': int(row['cost']),
+                              'capacity': capacity})
+    return vehicle_types
+
+# students a vehicle type carries in tier
+def type_capacity(vehicle_type, tier):
+    capacity = vehicle_type['capacity']
+    if isinstance(capacity, (list, tuple)):
+        return capacity[tier-1]
+    return capacity
+
+# vehicle types in the order buses are handed to the model: cheapest seat first,
+# then the biggest bus
+def type_order(vehicle_types, tier):
+    return sorted(vehicle_types, key=lambda t: (t['cost'] / float(type_capacity(t, tier)), -type_capacity(t, tier)))
+
+# share of every vehicle type for each school of a tier, in proportion to its students;
+# the remainder of a type goes to the schools with the largest fractions, in school order
+# on ties, so the same students always give the same shares. {school: {type: count}}
+def reserve_quotas(vehicle_types, school_students):
+    schools = list(school_students)
+    total = float(max(1, sum(school_students.values())))
+    quotas = {school: {} for school in schools}
+    for vehicle_type in vehicle_types:
+        shares = [vehicle_type['count'] * school_students[school] / total for school in schools]
+        counts = [int(math.floor(share)) for share in shares]
+        left = vehicle_type['count'] - sum(counts)
+        for i in sorted(range(len(schools)), key=lambda i: (counts[i] - shares[i], i))[:left]:
+            counts[i] += 1
+        for school, count in zip(schools, counts):
+            quotas[school][vehicle_type['type']] = count
+    return quotas
+
+# reserve_quotas of every tier; school_students is {school: students}. {school: {type: count}}
+def plan_quotas(vehicle_types, school_codes, school_students):
+    quotas = {}
+    for schools in school_codes:
+        quotas.update(reserve_quotas(vehicle_types, {school: school_students[school] for school in schools}))
+    return quotas
+
+# capacities and fixed costs of the buses of a quota ({type: count}) in tier, in type_order
+def quota_fleet(vehicle_types, quota, tier):
+    capacities = []
+    costs = []
+    for vehicle_type in type_order(vehicle_types, tier):
+        count = quota.get(vehicle_type['type'], 0)
+        capacities += [type_capacity(vehicle_type, tier)] * count
+        costs += [vehicle_type['cost']] * count
+    return capacities, costs
+
+# vehicle type that drives each route of a school, given the load of every route and
+# in the same order: the largest loads first, each on the smallest bus left in quota
+# that fits it, so the bigger buses the school did not need stay free for others
+def route_types(vehicle_types, quota, loads, tier):
+    left = dict(quota)
+    types = [None] * len(loads)
+    by_size = sorted(vehicle_types, key=lambda t: type_capacity(t, tier))
+    for i in sorted(range(len(loads)), key=lambda i: -loads[i]):
+        for vehicle_type in by_size:
+            if left.get(vehicle_type['type'], 0) > 0 and type_capacity(vehicle_type, tier) >= loads[i]:
+                left[vehicle_type['type']] -= 1
+                types[i] = vehicle_type['type']
+                break
+        else:
+            raise ValueError('A route of {} students fits on no bus of quota {}'.format(loads[i], quota))
+    return types
+
+# buses of each type a school's routes take out of its quota, see route_types. {type: count}
+def buses_taken(vehicle_types, quota, loads, tier):
+    taken = {vehicle_type['type']: 0 for vehicle_type in vehicle_types}
+    for name in route_types(vehicle_types, quota, loads, tier):
+        taken[name] += 1
+    return taken
+
+# set the vehicle_type of a school's routes (route_store.Route) of tier from its quota
+def type_routes(routes, vehicle_types, quota, tier):
+    for route, name in zip(routes, route_types(vehicle_types, quota, [route.load for route in routes], tier)):
+        route.vehicle_type = name
+    return routes
+
+# buses of every type left in tier after the schools in loads ({school: [route loads]})
+# took theirs out of quotas. {type: count}
+def unused_buses(vehicle_types, quotas, loads, tier):
+    left = {vehicle_type['type']: vehicle_type['count'] for vehicle_type in vehicle_types}
+    for school, school_loads in loads.items():
+        for name, count in buses_taken(vehicle_types, quotas[school], school_loads, tier).items():
+            left[name] -= count
+    return left
+
+# number of variables the routing model keeps for its next-stop decisions
+def model_size(num_nodes, num_vehicles):
+    return num_nodes + num_vehicles - 2
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+School locations and stop-to-school distances for the bus assignment phase.
+
+school_locations.csv is read once per run and kept as coordinate arrays, and the
+distances from a batch of stops to every school come from one vectorized
+evaluation of Vincenty's inverse formula on the WGS-84 ellipsoid. For the
+distances in the district this agrees with geopy.distance.distance to within
+a millimetre.
+"""
+
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# WGS-84 ellipsoid, the default of geopy.distance.distance
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+# largest difference from geopy.distance.distance in meters
+DISTANCE_TOLERANCE = 0.001
+
+# load school_locations.csv once into arrays of code, tier, latitude and longitude
+@lru_cache(maxsize=None)
+def load_school_locations(filename='school_locations.csv'):
+    school_locations = pd.read_csv(filename, delimiter=',').values
+    return {'school': school_locations[:, 2],
+            'tier': school_locations[:, 3].astype(int),
+            'latitude': school_locations[:, 1].astype(float),
+            'longitude': school_locations[:, 0].astype(float)}
+
+# geodesic distances in meters between the points (lat1, lon1) and (lat2, lon2),
+# which broadcast against each other like any NumPy arrays
+def geodesic_distances(lat1, lon1, lat2, lon2, iterations=200):
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*[np.radians(np.asarray(x, dtype=float))
+                                                   for x in (lat1, lon1, lat2, lon2)])
+    u1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    delta_lon = lon2 - lon1
+
+    lam = delta_lon
+    for i in range(iterations):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # points on the equator have no defined cos(2 sigma_m)
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+        c = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+        previous_lam = lam
+        lam = delta_lon + (1 - c) * WGS84_F * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+        if np.all(np.abs(lam - previous_lam) < 1e-12):
+            break
+
+    u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+        big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+    return WGS84_B * big_a * (sigma - delta_sigma)
+
+# distances from each (latitude, longitude) in coords to every school in tier or later;
+# one list per coordinate of (school, distance, tier) tuples sorted by distance.
+# school_tiers ({school: tier}) overrides the tiers in the file, e.g. to try a new layout
+def school_distances(coords, tier, filename='school_locations.csv', school_tiers=None):
+    schools = load_school_locations(filename)
+    tiers = schools['tier']
+    if school_tiers is not None:
+        tiers = np.array([school_tiers.get(school, t) for school, t in zip(schools['school'], tiers)], dtype=int)
+    candidates = np.flatnonzero(tiers >= tier)
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    dists = geodesic_distances(coords[:, 0, np.newaxis], coords[:, 1, np.newaxis],
+                               schools['latitude'][candidates], schools['longitude'][candidates])
+
+    d = []
+    for row in dists:
+        order = np.argsort(row, kind='stable')
+        d.append([(schools['school'][candidates[k]], float(row[k]), int(tiers[candidates[k]]))
+                  for k in order])
+    return d
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental update of a school's routes when a few of its stops change.
+
+A delta to a school's rows of Tier*_pm.csv lists the stops added, the names of the
+stops removed and the stops modified (new student count, time from school or
+location). The data model is patched instead of rebuilt: the time and distance
+planes of the stops that stay as they were are kept, and only the rows and columns
+of added and modified stops are read from the binary matrix store, which must have
+been converted with them (see distance_matrix.py), or asked of a travel time
+provider (travel_time.py).
+The routes are patched the way a warm start is (stops dropped, routes over capacity
+or too long shed stops, new stops put in by cheapest insertion), and only the routes
+that changed get a short local search.
+
+    delta = stop_delta(old_stops, new_stops)
+    data, opt_routes, school_stops = update_school(data, opt_routes, school_stops, delta, filename,
+                                                   pm_new.main, pm_new.create_search_parameters())
+    # new stops that are in no matrix file
+    data, opt_routes, school_stops = update_school(..., provider=CachedProvider(RoadGraphProvider('roads.csv')))
+"""
+
+import numpy as np
+
+from distance_matrix import build_time_matrix, time_plane_of, open_matrix_store
+from warm_start import repair_routes, route_time
+from decomposition import sub_data, to_school_nodes, total_time
+from travel_time import places_of
+
+REPAIR_TIME_LIMIT = 1   # seconds of local search for the routes a delta touches
+
+# delta between two versions of a school's rows of Tier*_pm.csv, matched by stop name
+def stop_delta(old_stops, new_stops):
+    old = {str(row[5]): row for row in old_stops[1:]}
+    new = {str(row[5]): row for row in new_stops[1:]}
+    return {'added': [row for name, row in new.items() if name not in old],
+            'removed': [name for name in old if name not in new],
+            'modified': [row for name, row in new.items()
+                         if name in old and list(row) != list(old[name])]}
+
+# the school's rows with the delta applied: the school, the stops that stay in
+# their order, then the added stops
+def apply_delta(school_stops, delta):
+    removed = set(str(name) for name in delta.get('removed', []))
+    modified = {str(row[5]): row for row in delta.get('modified', [])}
+    rows = [school_stops[0]]
+    for row in school_stops[1:]:
+        name = str(row[5])
+        if name not in removed:
+            rows.append(modified.get(name, row))
+    rows.extend(delta.get('added', []))
+    return np.array(rows, dtype=object)
+
+# (distance, time) planes of the stops in names: planes of the stops the model
+# already has are taken from it, only added stops and the stops in changed (e.g. a
+# stop that moved) are read from the matrix store, or asked of provider for the
+# places (see travel_time.py) of the stops
+def patch_planes(data, names, filename, provider=None, places=None, changed=()):
+    old_node = {str(name): node for node, name in enumerate(data['stop_names']) if node > 0}
+    changed = set(str(name) for name in changed)
+    kept = np.array([i for i, name in enumerate(names) if name in old_node and name not in changed], dtype=int)
+    fresh = np.array([i for i, name in enumerate(names) if name not in old_node or name in changed], dtype=int)
+    old_nodes = np.array([old_node[names[i]] for i in kept], dtype=int)
+    if len(fresh) == 0:
+        time_plane = time_plane_of(data['time_matrix'], data['students'])
+        return (np.asarray(data['distance_matrix'])[np.ix_(old_nodes-1, old_nodes-1)],
+                time_plane[np.ix_(old_nodes-1, old_nodes-1)])
+
+    if provider is not None:
+        # whole rows of the fresh stops, and their columns for every other stop
+        fresh_rows = provider.many_to_many([places[i] for i in fresh], places)
+        fresh_columns = provider.many_to_many([places[i] for i in kept], [places[i] for i in fresh])
+        for plane in fresh_rows:
+            plane[np.arange(len(fresh)), fresh] = 0
+    else:
+        distance_store, time_store, store_ids = open_matrix_store(filename)
+        row_of = {str(stop): row for row, stop in enumerate(store_ids)}
+        missing = [name for name in names if name not in row_of]
+        if missing:
+            raise KeyError('{} has no rows for stops {}'.format(filename, missing))
+        rows = np.array([row_of[name] for name in names], dtype=np.intp)
+        fresh_rows = [np.asarray(store[rows[fresh]])[:, rows] for store in [distance_store, time_store]]
+        fresh_columns = [np.asarray(store[np.ix_(rows[kept], rows[fresh])])
+                         for store in [distance_store, time_store]]
+
+    planes = []
+    old_planes = [np.asarray(data['distance_matrix']), time_plane_of(data['time_matrix'], data['students'])]
+    for old_plane, rows_of_fresh, columns_of_fresh in zip(old_planes, fresh_rows, fresh_columns):
+        plane = np.empty((len(names), len(names)), dtype=np.int64)
+        plane[np.ix_(kept, kept)] = old_plane[np.ix_(old_nodes-1, old_nodes-1)]
+        plane[fresh, :] = np.rint(rows_of_fresh)
+        plane[np.ix_(kept, fresh)] = np.rint(columns_of_fresh)
+        planes.append(plane)
+    return planes[0], planes[1]
+
+# data model of the school after the delta; school_stops are its rows before the delta
+def update_data(data, school_stops, delta, filename, provider=None):
+    stops = apply_delta(school_stops, delta)
+    names = [str(name) for name in stops[1:, 5]]
+    distance_plane, time_plane = patch_planes(data, names, filename, provider, places_of(stops[1:]),
+                                              [row[5] for row in delta.get('modified', [])])
+    students = -1 * stops[:, 7].astype(np.int64)
+
+    updated = dict(data)
+    updated['students'] = students.tolist()
+    updated['stop_names'] = stops[:, 5]
+    updated['latitude'] = stops[:, 1].astype(float)
+    updated['longitude'] = stops[:, 0].astype(float)
+    updated['distance_matrix'] = distance_plane
+    updated['time_matrix'] = build_time_matrix(stops[:, 11].astype(np.int64), time_plane, students)
+    updated['ends'] = [len(updated['time_matrix'])-1 for i in range(data['num_vehicles'])]
+    return updated, stops
+
+# [route, route_time, route_load] of a list of stop nodes, like analyze_solution makes
+def as_opt_route(route, data):
+    return [[(0, data['students'][0])] + [(node, data['students'][node]) for node in route],
+            int(route_time(route, data['time_matrix'])), sum(data['students'][node] for node in route)]
+
+# apply a delta to a school's solved routes. solve is pm_new.main; it re-solves only
+# the routes the delta changed, for at most time_limit seconds, and the whole school
+# with search_parameters when the changed stops cannot be put on any bus. Returns the
+# new data model, routes and rows of the school, whose nodes match. The planes of added
+# and modified stops come from provider when one is given, otherwise from the matrix store
+def update_school(data, opt_routes, school_stops, delta, filename, solve, search_parameters, options=None,
+                  time_limit=REPAIR_TIME_LIMIT, provider=None):
+    updated, stops = update_data(data, school_stops, delta, filename, provider)
+    previous_routes = [[str(data['stop_names'][node]) for node, students in opt_route[0][1:]]
+                       for opt_route in opt_routes]
+    repaired = repair_routes(previous_routes, updated)
+    if repaired is None:
+        print('Changed stops do not fit on the current routes, solving the school again')
+        return updated, solve(updated, options, search_parameters), stops
+
+    # routes whose stops changed in any way, including modified stops on them
+    modified = set(str(row[5]) for row in delta.get('modified', []))
+    routes = []
+    affected = []
+    for names, route in zip(previous_routes + [[] for i in range(len(repaired))], repaired):
+        if not route:
+            continue
+        new_names = [str(updated['stop_names'][node]) for node in route]
+        if new_names != names or modified.intersection(new_names):
+            affected.append(route)
+        else:
+            routes.append(as_opt_route(route, updated))
+    patched = [as_opt_route(route, updated) for route in affected]
+    if not affected:
+        return updated, routes, stops
+
+    # short local search on just the changed routes, kept when it is not worse
+    sub, index = sub_data(updated, np.array([node for route in affected for node in route]))
+    repair_parameters = type(search_parameters)()
+    repair_parameters.CopyFrom(search_parameters)
+    repair_parameters.time_limit.seconds = time_limit
+    improved = to_school_nodes(solve(sub, options, repair_parameters,
+                                     [[str(updated['stop_names'][node]) for node in route] for route in affected]),
+                               index)
+    if improved and total_time(improved) <= total_time(patched):
+        patched = improved
+    return updated, routes + patched, stops
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Phase timings and solver statistics of a run.
+
+A sink receives one record per event. Phases are timed with
+
+    with sink.phase('matrix', tier=1, school='JHS') as fields:
+        ...
+        fields['stops'] = 20     # extra fields of the record
+
+and solver statistics (status, objective, solutions, vehicles used) are recorded
+with sink.record('solver', ...). NULL_SINK drops everything and costs next to
+nothing, so the hooks stay in place when metrics are disabled; JsonLinesSink appends
+every record as one JSON line to a file, which worker processes can share.
+"""
+
+import json
+import os
+import threading
+import time
+
+class NullSink:
+    enabled = False
+
+    def __init__(self, **tags):
+        self.tags = tags
+
+    # a sink whose records also carry tags, e.g. the tier and school being solved
+    def tagged(self, **tags):
+        return self
+
+    def phase(self, name, **tags):
+        return _NULL_PHASE
+
+    def record(self, event, **fields):
+        pass
+
+class _NullPhase:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_PHASE = _NullPhase()
+NULL_SINK = NullSink()
+
+class _Phase:
+    def __init__(self, sink, name, fields):
+        self.sink = sink
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.perf_counter() - self.start_time
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self.sink.record('phase', phase=self.name, wall_time=round(wall_time, 6), **self.fields)
+        return False
+
+class JsonLinesSink(NullSink):
+    enabled = True
+
+    def __init__(self, filename, **tags):
+        NullSink.__init__(self, **tags)
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def tagged(self, **tags):
+        return JsonLinesSink(self.filename, **dict(self.tags, **tags))
+
+    def phase(self, name, **tags):
+        return _Phase(self, name, tags)
+
+    # every record is one write of a whole line in append mode, so records of
+    # processes writing to the same file do not interleave
+    def record(self, event, **fields):
+        line = json.dumps(dict(self.tags, time=round(time.time(), 3), pid=os.getpid(), event=event, **fields),
+                          default=_to_json)
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write(line + '\n')
+
+    # the lock is not sent to worker processes, each gets its own
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+# numpy numbers and other values json does not know
+def _to_json(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+# a sink writing to filename, or NULL_SINK when filename is None
+def open_sink(filename, **tags):
+    if filename is None:
+        return NULL_SINK
+    return JsonLinesSink(filename, **tags)
@@ -11,13 +11,28 @@ Created on Thu May  7 15:16:24 2020
 
 # NEED to have these installed before running code
 # python -m pip install --upgrade --user ortools
-# pip install geopy
 
 from __future__ import print_function
 from ortools.constraint_solver import routing_enums_pb2, pywrapcp
-from geopy.distance import distance
+from geodesic import school_distances
+from distance_matrix import load_school_matrix, build_time_matrix
+from fleet import fleet_upper_bound, grow_fleet, model_size, plan_quotas, quota_fleet, unused_buses, type_routes
+from route_store import build_routes, export_routes
+from bus_chaining import assign_buses, compare_chaining, last_stop_distances, which_tier, buses_in_service
+from solve_cache import cache_key, load_routes, store_routes, clear_cache
+from warm_start import read_route_file, repair_routes
+from search_budget import scaled_time_limit, SearchMonitor, RunBudget
+from metrics import NULL_SINK, open_sink
+from decomposition import solve_decomposed
+from neighbors import restrict_arcs, register_sparse_transit
+from portfolio import solve_portfolio, default_parameters
+from travel_time import open_provider
 import pandas as pd
+import numpy as np
 import datetime
+import time
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 '''
 Reads in PM data for each school by tier. Optimizes the routes to each school
@@ -27,130 +42,312 @@ buses' last position and the next school in the next tier. Does not assign depot
 Files:
 Tier*\\Tier*_pm.csv           -> latitude, longitude, stop's school, stop, students, distance from school
 Tier*\\SCHOOL_pmDistance.csv  -> distance matrix from each stop to another stop for the school
-Tier*\\SCHOOL_pmRouteData.csv -> output of the optimized routes per school
-bus_assignments.csv           -> table of buses and their assigned routes, duration and load of each route
+Tier*\\SCHOOL_pmMatrix.npy    -> the same matrix converted by distance_matrix.py (optional, faster to load)
+Tier*\\SCHOOL_pmRouteData.csv -> output of the optimized routes per school (optional)
+bus_assignments.csv           -> table of buses and their assigned routes, duration, load and bus type of each route
 school_locations.csv          -> latitude and longitude of each school and depot capacity
 
 Need to have the above imports imported (refer to commented section above imports)
 Need to have this file in the same location as the above files
 '''
 
-# load in the data for the schools in the same Tier
-def load_tier_data(tier):
+# load in the data for the schools in the same Tier, from the Tier* folders in directory
+def load_tier_data(tier, directory=''):
     # load capacity per stop (number of students) and distance and time to schools from stop
-    stops_data = pd.read_csv('Tier'+str(tier)+'\\'+'Tier'+str(tier)+'_pm.csv', delimiter=',')
+    stops_data = pd.read_csv(os.path.join(directory, 'Tier'+str(tier)+'\\'+'Tier'+str(tier)+'_pm.csv'), delimiter=',')
     stops_data = stops_data.values
     return stops_data
 
 # create data dictionary for the ortools to solve the CVRP
-def create_data_model(school_code, filename, stops_data):
-    # load in time matrix data
-    time_data = pd.read_csv(filename, delimiter=',', header=None)
-    time_data = time_data.values
+# vehicle_costs, if given, is the fixed cost of sending out each bus; matrix, if given,
+# is the school's (distance, time) planes already in memory instead of filename
+def create_data_model(school_code, filename, stops_data, vehicle_capacities, max_route_time, vehicle_costs=None,
+                      matrix=None):
+    school_stops = stops_data[stops_data[:, 4] == school_code]
+    # load in time matrix data, from the binary store when it has been converted
+    if matrix is not None:
+        distance_plane, time_plane = matrix
+    else:
+        distance_plane, time_plane = load_school_matrix(filename, school_stops[1:, 5])
 
     # create data matrix; add the school as depot to the time matrix in 0th row and col
-    numStops = len(time_data)
-    time_matrix = [[int(row[11]) for row in stops_data if row[4]==school_code]]
-    time_matrix[0].append(0)
-    for i in range(numStops):
-        row = [time_matrix[0][i+1]]
-        for j in range(numStops):
-            temp = time_data[i][j].lstrip('(').rstrip(')').split(',')
-            row.append(int(temp[1]))
-        row.append(0)  # for the dummy stop
-        time_matrix.append(row)
-
-    # add dummy stop to the time matrix
-    dummy_stop = [0 for i in range(len(stops_data))]
-    time_matrix.append(dummy_stop.append(0))
+    depot_times = school_stops[:, 11].astype(np.int64)
+    students = -1 * school_stops[:, 7].astype(np.int64)
 
     data = {}
-    data['students'] = [-1*int(row[7]) for row in stops_data if row[4]==school_code]
+    data['school'] = school_code
+    data['students'] = students.tolist()
+    data['stop_names'] = school_stops[:, 5]
+    data['latitude'] = school_stops[:, 1].astype(float)
+    data['longitude'] = school_stops[:, 0].astype(float)
+    data['distance_matrix'] = distance_plane
     # adjust time at stops based on number of students to pick up
-    # stops with 5 or less take a minute, after that its 10 seconds a kid
-    for i in range(1,len(time_matrix)-1):
-        for j in range(1,len(time_matrix[i])-1):
-            if i == j:
-                pass
-            elif data['students'][j] <= 5:
-                time_matrix[i][j] += 60
-            else:
-                time_matrix[i][j] = time_matrix[i][j] + 60 + (data['students'][j]-5 * 10)
-
-    data['time_matrix'] = time_matrix
-    data['num_vehicles'] = len(buses_avail)
-    data['vehicle_capacities'] = buses_avail
+    data['time_matrix'] = build_time_matrix(depot_times, time_plane, students)
+    data['num_vehicles'] = len(vehicle_capacities)
+    data['vehicle_capacities'] = vehicle_capacities
+    data['vehicle_costs'] = vehicle_costs
+    data['max_route_time'] = max_route_time
     data['starts'] = [0 for i in range(data['num_vehicles'])]
-    data['ends'] = [len(time_matrix)-1 for i in range(data['num_vehicles'])]
+    data['ends'] = [len(data['time_matrix'])-1 for i in range(data['num_vehicles'])]
     return data
 
-# find local optimum for CVRP problem
-# adapted from https://developers.google.com/optimization/routing/cvrp
-def main(data):
+# build the routing model for the CVRP
+# engine 'matrix' hands the time matrix and student counts to the solver so arcs
+# are evaluated natively; engine 'callback' asks the Python callbacks for every arc.
+# with neighbors a stop can only be followed by its neighbors nearest stops, and the
+# time of the arcs comes from a callback over those stops instead of the dense matrix
+def build_model(data, engine='matrix', neighbors=None):
     manager = pywrapcp.RoutingIndexManager(len(data['time_matrix']), data['num_vehicles'],
                                            data['starts'], data['ends'])
     routing = pywrapcp.RoutingModel(manager)
 
-    def time_callback(from_index, to_index):
-        # returns the time between two nodes
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data['time_matrix'][from_node][to_node]
+    transit_callback_index = register_sparse_transit(data, manager, routing, neighbors)
+    if engine == 'matrix':
+        if transit_callback_index is None:
+            transit_callback_index = routing.RegisterTransitMatrix(data['time_matrix'].tolist())
+        student_callback_index = routing.RegisterUnaryTransitVector(data['students'])
+    elif engine == 'callback':
+        if transit_callback_index is None:
+            time_matrix = data['time_matrix'].tolist()
+
+            def time_callback(from_index, to_index):
+                # returns the time between two nodes
+                from_node = manager.IndexToNode(from_index)
+                to_node = manager.IndexToNode(to_index)
+                return time_matrix[from_node][to_node]
+
+            transit_callback_index = routing.RegisterTransitCallback(time_callback)
+
+        def student_callback(from_index):
+            from_node = manager.IndexToNode(from_index)
+            return data['students'][from_node]
 
-    def student_callback(from_index):
-        from_node = manager.IndexToNode(from_index)
-        return data['students'][from_node]
+        student_callback_index = routing.RegisterUnaryTransitCallback(student_callback)
+    else:
+        raise ValueError('Unknown engine: {}'.format(engine))
 
     # time callback, define cost of each arc
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
     # add student capacity constraint
     routing.AddDimension(
         transit_callback_index,
         0,        # no waiting time necessary
-        max_route_time,
+        data['max_route_time'],
         True,     # start cumul at 0
         'Time')
 
-    student_callback_index = routing.RegisterUnaryTransitCallback(student_callback)
     routing.AddDimensionWithVehicleCapacity(
         student_callback_index,
         0,                            # null capacity slack
         data['vehicle_capacities'],   # vehicle maximum capacities
         True,                         # start cumul to zero
         'Capacity')
-
-    # setting first solution heuristics
+    # cost of sending out each bus, so cheaper buses are used first
+    if data.get('vehicle_costs') is not None:
+        for vehicle_id, cost in enumerate(data['vehicle_costs']):
+            routing.SetFixedCostOfVehicle(int(cost), vehicle_id)
+
+    restrict_arcs(data, manager, routing, neighbors)
+    return manager, routing
+
+# settings of how each school is solved; __main__ overrides them
+SOLVE_OPTIONS = {'engine': 'matrix',          # 'matrix' or 'callback', see build_model
+                 'fleet_sizing': True,        # model only as many buses as a school is likely to need
+                 'cache_dir': None,           # directory of the solve cache, None to always solve
+                 'warm_start': False,         # start from the last SCHOOL_pmRouteData.csv
+                 'warm_start_time_limit': 10, # seconds of search for a warm-started school
+                 'time_policy': 'fixed',      # 'fixed' time_limit per school or 'scaled' by number of stops
+                 'time_limit': 100,           # seconds of search per school, the maximum when scaled
+                 'stall_seconds': None,       # stop after this long without improving, None to never
+                 'min_improvement': 0.0,      # smallest fraction of the objective counted as improving
+                 'neighbors': None,           # keep only arcs to the k nearest stops, see neighbors.py
+                 'max_cluster_size': None,    # solve schools with more stops in clusters of this size, see decomposition.py
+                 'cluster_workers': 1,        # clusters of a school solved at once
+                 'repair_time_limit': 10,     # seconds of search to repair each pair of neighbouring clusters
+                 'portfolio': 0,              # race this many search configurations per school, see portfolio.py
+                 'portfolio_history': None,   # directory of which configuration won each school
+                 'cancel': None,              # threading.Event that stops the search when set
+                 'target_objective': None,    # objective at which the search sets cancel
+                 'metrics': None}             # metrics.JsonLinesSink for phase timings and solver statistics
+
+# setting first solution heuristics
+def create_search_parameters(time_limit=100):
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.time_limit.seconds = 100
+    search_parameters.time_limit.seconds = time_limit
     search_parameters.first_solution_strategy = (
         routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    return search_parameters
+
+# counters of the last search, used to compare how much searching each engine gets done
+def search_stats(routing):
+    solver = routing.solver()
+    return {'branches': solver.Branches(),
+            'neighbors': solver.AcceptedNeighbors(),
+            'solutions': solver.Solutions(),
+            'wall_time': solver.WallTime() / 1000}
+
+# buses of the solution that leave the school
+def vehicles_used(routing, solution):
+    return sum(1 for vehicle_id in range(routing.vehicles())
+               if not routing.IsEnd(solution.Value(routing.NextVar(routing.Start(vehicle_id)))))
+
+def print_search_stats(engine, stats):
+    print('Search ({}): {} branches, {} accepted neighbors, {} solutions in {:.1f}sec'.format(
+        engine, stats['branches'], stats['neighbors'], stats['solutions'], stats['wall_time']))
+
+# restrict the data model to the first num_vehicles buses of its fleet
+def with_fleet(data, num_vehicles):
+    sized = dict(data)
+    sized['num_vehicles'] = num_vehicles
+    sized['vehicle_capacities'] = data['vehicle_capacities'][:num_vehicles]
+    if data.get('vehicle_costs') is not None:
+        sized['vehicle_costs'] = data['vehicle_costs'][:num_vehicles]
+    sized['starts'] = data['starts'][:num_vehicles]
+    sized['ends'] = data['ends'][:num_vehicles]
+    return sized
+
+# build and solve the model, printing its size and how long the search took;
+# the search starts from initial_routes (lists of nodes, one per bus) when given
+def solve_model(data, options=None, search_parameters=None, initial_routes=None):
+    options = dict(SOLVE_OPTIONS, **(options or {}))
+    if search_parameters is None:
+        search_parameters = create_search_parameters()
+    metrics = options['metrics'] or NULL_SINK
+    start_time = time.time()
+    with metrics.phase('model', buses=data['num_vehicles']):
+        manager, routing = build_model(data, options['engine'], options['neighbors'])
+    monitor = SearchMonitor(routing, options['stall_seconds'], options['min_improvement'], options['cancel'],
+                            options['target_objective'])
+    initial_solution = None
+    if initial_routes is not None:
+        routing.CloseModelWithParameters(search_parameters)
+        initial_solution = routing.ReadAssignmentFromRoutes(
+            [[manager.NodeToIndex(node) for node in route] for route in initial_routes], True)
+        if initial_solution is None:
+            print('Could not start from the previous routes, starting from scratch')
     # solve the problem
-    solution = routing.SolveWithParameters(search_parameters)
+    with metrics.phase('search', buses=data['num_vehicles'], warm_start=initial_solution is not None):
+        if initial_solution is not None:
+            solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
+        else:
+            solution = routing.SolveWithParameters(search_parameters)
+    stats = search_stats(routing)
+    print_search_stats(options['engine'], stats)
+    if metrics.enabled:
+        metrics.record('solver', status=routing.status(), buses=data['num_vehicles'],
+                       objective=solution.ObjectiveValue() if solution else None,
+                       vehicles_used=vehicles_used(routing, solution) if solution else 0,
+                       improvements=len(monitor.trajectory), **stats)
+    print('Model with {} buses: {} variables, solved in {:.1f}sec'.format(
+        data['num_vehicles'], model_size(len(data['time_matrix']), data['num_vehicles']),
+        time.time() - start_time))
+    print('Improvement trajectory: {}: {}'.format(monitor.summary(), monitor.trajectory))
+    return manager, routing, solution
+
+# find local optimum for CVRP problem
+# adapted from https://developers.google.com/optimization/routing/cvrp
+# with fleet_sizing the school is modelled with only as many buses as its students
+# need plus slack, and the fleet grows only when no solution is found with it.
+# previous_routes (stop names per route) warm-start the search from an earlier plan
+def main(data, options=None, search_parameters=None, previous_routes=None):
+    options = dict(SOLVE_OPTIONS, **(options or {}))
+    fleet_size = data['num_vehicles']
+    num_vehicles = fleet_size
+    if options['fleet_sizing']:
+        num_vehicles = fleet_upper_bound(data['students'], data['vehicle_capacities'])
+        if previous_routes is not None:
+            num_vehicles = max(num_vehicles, len(previous_routes))
+        num_vehicles = min(num_vehicles, fleet_size)
+        print('Fleet sizing: {} of {} buses, {} variables instead of {}'.format(
+            num_vehicles, fleet_size, model_size(len(data['time_matrix']), num_vehicles),
+            model_size(len(data['time_matrix']), fleet_size)))
+
+    while True:
+        sized = with_fleet(data, num_vehicles)
+        initial_routes = None
+        if previous_routes is not None:
+            initial_routes = repair_routes(previous_routes, sized)
+        manager, routing, solution = solve_model(sized, options, search_parameters, initial_routes)
+        if solution or num_vehicles >= fleet_size:
+            break
+        print('No solution with {} buses (status {}), re-solving with more'.format(num_vehicles, routing.status()))
+        num_vehicles = grow_fleet(num_vehicles, fleet_size)
 
     if solution:
-        analyze_solution(data, manager, routing, solution)
-    else:
-        print(routing.status())
+        return analyze_solution(sized, manager, routing, solution)
+    print(routing.status())
+    return []
+
+# solve a school whole with main, or in clusters when it has more than
+# options['max_cluster_size'] stops, or race options['portfolio'] search configurations
+def solve_data(data, options=None, search_parameters=None, previous_routes=None):
+    options = dict(SOLVE_OPTIONS, **(options or {}))
+    if search_parameters is None:
+        search_parameters = create_search_parameters()
+    if options['portfolio'] > 1 and previous_routes is None:
+        return solve_portfolio(data, solve_data, options, search_parameters, options['portfolio'],
+                               options['portfolio_history'])
+    max_cluster_size = options['max_cluster_size']
+    if max_cluster_size is None or len(data['students'])-1 <= max_cluster_size:
+        return main(data, options, search_parameters, previous_routes)
+    return solve_decomposed(data, main, options, search_parameters, max_cluster_size, options['cluster_workers'],
+                            options['repair_time_limit'], previous_routes=previous_routes)
+
+# solve the same school with the whole fleet and with the sized fleet
+# to see how much smaller and faster the sized model is
+def compare_fleet_sizing(data, options=None):
+    results = {}
+    for fleet_sizing in [False, True]:
+        start_time = time.time()
+        opt_routes = main(data, dict(options or {}, fleet_sizing=fleet_sizing))
+        results[fleet_sizing] = {'buses': len(opt_routes),
+                                 'route_time': sum(route[1] for route in opt_routes),
+                                 'wall_time': time.time() - start_time}
+    print('Whole fleet: {buses} buses, {route_time}sec of routes in {wall_time:.1f}sec'.format(**results[False]))
+    print('Sized fleet: {buses} buses, {route_time}sec of routes in {wall_time:.1f}sec'.format(**results[True]))
+    return results
+
+# solve the same school with both engines and report how many more local-search
+# iterations the native matrix gets within the same time limit
+def compare_engines(data, search_parameters=None):
+    if search_parameters is None:
+        search_parameters = create_search_parameters()
+    stats = {}
+    for engine in ['callback', 'matrix']:
+        manager, routing = build_model(data, engine)
+        solution = routing.SolveWithParameters(search_parameters)
+        stats[engine] = search_stats(routing)
+        stats[engine]['objective'] = solution.ObjectiveValue() if solution else None
+        print_search_stats(engine, stats[engine])
+
+    branch_rates = {engine: s['branches'] / max(s['wall_time'], 1e-3) for engine, s in stats.items()}
+    print('Matrix engine searched {:.1f}x as many branches per second as callbacks'.format(
+        branch_rates['matrix'] / max(branch_rates['callback'], 1e-3)))
+    return stats
 
 # print and keep track of route from local solution
+# the time of a route is read from the Time dimension rather than the arc costs,
+# which include the fixed cost of the bus on its first arc
 def analyze_solution(data, manager, routing, solution):
+    time_dimension = routing.GetDimensionOrDie('Time')
+    opt_routes = []
     total_time = 0
     total_load = 0
     for vehicle_id in range(data['num_vehicles']):
         index = routing.Start(vehicle_id)
         plan_output = 'Route for vehicle {}:\n'.format(vehicle_id)
-        route_time = 0
         route_load = 0
         route = []
         while not routing.IsEnd(solution.Value(routing.NextVar(index))):
             node_index = manager.IndexToNode(index)
             route_load += data['students'][node_index]
             plan_output += ' {0} Load({1}) -> '.format(node_index, route_load)
-            previous_index = index
             index = solution.Value(routing.NextVar(index))
-            route_time += routing.GetArcCostForVehicle(previous_index, index, vehicle_id)
             route.append((node_index, data['students'][node_index]))
+        route_time = 0
+        if route:
+            route_time = (solution.Value(time_dimension.CumulVar(routing.End(vehicle_id))) -
+                          solution.Value(time_dimension.CumulVar(routing.Start(vehicle_id))))
 
         plan_output += ' {0} Load({1})\n'.format(manager.IndexToNode(index), route_load)
         plan_output += 'Time of the route: {} sec\n'.format(route_time)
@@ -163,154 +360,254 @@ def analyze_solution(data, manager, routing, solution):
         if route_time != 0:
             # print(plan_output)
             # print(route)
-            buses_avail[vehicle_id] = 0
-            buses_used_counter.append(1)
             opt_routes.append([route, route_time, route_load])
     print('Total time of all routes: {}sec'.format(total_time))
     print('Total load of all routes: {}'.format(total_load))
-
-# save routes to external csv file
-def output_routes(opt_routes, tier, school, stops_data):
-    routeDict = {'route': [],
-                 'latitude': [],
-                 'longitude': [],
-                 'stop name': [],
-                 'count': [],
-                 'order': []}
-    stops_data = [row for row in stops_data if row[4] == school]
-
-    for i in range(len(opt_routes)):
-        for j in range(len(opt_routes[i][0])):
-            stop = opt_routes[i][0][j][0]
-            routeDict['route'].append(i)
-            routeDict['latitude'].append(stops_data[stop][1])
-            routeDict['longitude'].append(stops_data[stop][0])
-            routeDict['stop name'].append(stops_data[stop][5])
-            routeDict['count'].append(-1*opt_routes[i][0][j][1])
-            routeDict['order'].append(j+1)
-
-    routeData = pd.DataFrame(routeDict)
-    routeData.to_csv('Tier'+str(tier)+'\\'+school+'_pmRouteData.csv', index=False)
+    return opt_routes
+
+# time limit of the search for a school with num_stops stops
+def school_time_limit(num_stops, options=None):
+    options = dict(SOLVE_OPTIONS, **(options or {}))
+    if options['time_policy'] == 'scaled':
+        return scaled_time_limit(num_stops, maximum=options['time_limit'])
+    return options['time_limit']
+
+# optimize the routes of one school; runs in a worker process in parallel mode,
+# so everything it needs is passed in rather than read from module globals
+# schools whose inputs match an earlier run are taken from the cache in options['cache_dir'].
+# with options['warm_start'] the search starts from the routes in the school's last
+# SCHOOL_pmRouteData.csv and gets at most options['warm_start_time_limit'] seconds
+# directory holds the Tier* folders, matrix the school's planes when they are in memory
+def solve_school(tier, school, stops_data, vehicle_capacities, max_route_time, options=None, time_limit=None,
+                 vehicle_costs=None, directory='', matrix=None):
+    options = dict(SOLVE_OPTIONS, **(options or {}))
+    # every record of this school carries its tier and code
+    metrics = (options['metrics'] or NULL_SINK).tagged(tier=tier, school=school)
+    options['metrics'] = metrics
+    print('\nOptimizing routes for ' + school + '...')
+    with metrics.phase('matrix') as fields:
+        data = create_data_model(school, os.path.join(directory, 'Tier'+str(tier)+'\\'+school+'_pmDistance.csv'),
+                                 stops_data, vehicle_capacities, max_route_time, vehicle_costs, matrix)
+        fields['stops'] = len(data['students'])-1
+    if time_limit is None:
+        time_limit = school_time_limit(len(data['students'])-1, options)
+    previous_routes = None
+    if options['warm_start']:
+        previous_routes = read_route_file(os.path.join(directory, 'Tier'+str(tier)+'\\'+school+'_pmRouteData.csv'))
+    if previous_routes is not None:
+        time_limit = min(time_limit, options['warm_start_time_limit'])
+    search_parameters = create_search_parameters(time_limit)
+    return solve_cached(data, options, search_parameters, previous_routes)
+
+# solve a data model with solve_data, or take its routes from the cache in
+# options['cache_dir'] when it was solved with the same inputs before
+def solve_cached(data, options=None, search_parameters=None, previous_routes=None):
+    options = dict(SOLVE_OPTIONS, **(options or {}))
+    metrics = options['metrics'] or NULL_SINK
+    if search_parameters is None:
+        search_parameters = create_search_parameters(options['time_limit'])
+    if options['portfolio'] <= 1 and options['portfolio_history'] is not None:
+        # the configuration that won this school most often in earlier portfolios
+        search_parameters = default_parameters(search_parameters, data.get('school'), options['portfolio_history'])
+    time_limit = search_parameters.time_limit.seconds
+    if options['cache_dir'] is None:
+        with metrics.phase('solve', time_limit=time_limit):
+            return solve_data(data, options, search_parameters, previous_routes)
+
+    key = cache_key(data, search_parameters, engine=options['engine'], fleet_sizing=options['fleet_sizing'],
+                    stall_seconds=options['stall_seconds'], min_improvement=options['min_improvement'],
+                    neighbors=options['neighbors'], max_cluster_size=options['max_cluster_size'],
+                    repair_time_limit=options['repair_time_limit'], portfolio=options['portfolio'],
+                    previous_routes=previous_routes)
+    opt_routes = load_routes(key, options['cache_dir'])
+    metrics.record('cache', hit=opt_routes is not None)
+    if opt_routes is not None:
+        print('Using cached routes')
+        return opt_routes
+    with metrics.phase('solve', time_limit=time_limit):
+        opt_routes = solve_data(data, options, search_parameters, previous_routes)
+    if opt_routes:
+        store_routes(key, opt_routes, options['cache_dir'])
+    return opt_routes
+
+# optimize every (tier, school) in schools, one worker process per school when
+# workers > 1; routes come back in the same order as schools. With run_budget
+# (seconds) the schools share one wall-clock budget, and each school's time limit
+# is set when it starts so that time left over by earlier schools goes to later ones.
+# fleets ({school: (vehicle_capacities, vehicle_costs)}) gives each school its own buses
+def solve_schools(schools, stops_data, vehicle_capacities, max_route_time, options=None, workers=1,
+                  run_budget=None, fleets=None):
+    options = dict(SOLVE_OPTIONS, **(options or {}))
+    if fleets is None:
+        fleets = {school: (vehicle_capacities, None) for tier, school in schools}
+    args = [(tier, school, stops_data[tier], fleets[school][0], max_route_time, options)
+            for tier, school in schools]
+    budget = RunBudget(run_budget, len(schools), workers) if run_budget is not None else None
+
+    def time_limit(i):
+        tier, school = schools[i]
+        limit = school_time_limit(int(np.sum(stops_data[tier][:, 4] == school))-1, options)
+        return budget.allot(limit) if budget is not None else limit
+
+    if workers <= 1:
+        return [solve_school(*args[i], time_limit=time_limit(i), vehicle_costs=fleets[schools[i][1]][1])
+                for i in range(len(args))]
+
+    solved = [None] * len(args)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        next_school = 0
+        while next_school < len(args) or running:
+            while next_school < len(args) and len(running) < workers:
+                future = executor.submit(solve_school, *args[next_school], time_limit=time_limit(next_school),
+                                         vehicle_costs=fleets[schools[next_school][1]][1])
+                running[future] = next_school
+                next_school += 1
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                solved[running.pop(future)] = future.result()
+    return solved
+
+# solve again, one at a time, the schools of a mixed fleet that found no routes with
+# their quota ({school: {type: count}}, see fleet.plan_quotas), each with every bus its
+# tier's other schools left unused; solved is in the order of schools, as solve_schools
+# returns it, and quotas is updated with the buses each school was given. Raises when
+# a school still finds no routes
+def solve_short_schools(schools, solved, stops_data, vehicle_types, quotas, max_route_time, options=None,
+                        directory=''):
+    solved = list(solved)
+    for i, (tier, school) in enumerate(schools):
+        students = -stops_data[tier][stops_data[tier][:, 4] == school][:, 7].sum()
+        if solved[i] or students <= 0:
+            continue
+        loads = {other: [route[2] for route in solved[j]] for j, (other_tier, other) in enumerate(schools)
+                 if other_tier == tier and other != school and solved[j]}
+        quotas[school] = unused_buses(vehicle_types, quotas, loads, tier)
+        vehicle_capacities, vehicle_costs = quota_fleet(vehicle_types, quotas[school], tier)
+        if vehicle_capacities:
+            print('\n{} found no routes with its share of the fleet, solving it again with the {} buses '
+                  'left in tier {}'.format(school, len(vehicle_capacities), tier))
+            solved[i] = solve_school(tier, school, stops_data[tier], vehicle_capacities, max_route_time, options,
+                                     vehicle_costs=vehicle_costs, directory=directory)
+        if not solved[i]:
+            raise RuntimeError('{} found no routes with the {} buses left in tier {}'.format(
+                school, len(vehicle_capacities), tier))
+    return solved
 
 # calculate distances between buses' last stops and next tier schools
 def calc_distances(x_coord, tier):
-    school_locations = pd.read_csv('school_locations.csv', delimiter=',')
-    school_locations = school_locations.values
-
-    d = []
-    for i in range(len(school_locations)):
-         if school_locations[i][3] >= tier:
-             y_coord = (school_locations[i][1],school_locations[i][0])
-             dist = distance(x_coord, y_coord).m
-             d.append((school_locations[i][2], dist, school_locations[i][3]))
-
-    d.sort(key=lambda x: x[1])
-    return d
-
-def which_tier(school):
-    temp = 0
-    for t, s in enumerate(school_codes):
-        if school in s:
-            temp = t+1
-
-    return temp
+    return school_distances([x_coord], tier)[0]
 
 if __name__ == '__main__':
     tiers = 3
     routes = {}
     numBuses = 97
     bus_capacity = 54
+    # vehicle types of a mixed fleet, None for numBuses buses of bus_capacity; each type has
+    # a capacity (or one per tier), a count and a fixed cost per bus sent out, in seconds of
+    # route time, or read them with fleet.load_vehicle_types('vehicle_types.csv'), e.g.
+    # [{'type': 'conventional', 'count': 97, 'cost': 0, 'capacity': [54, 54, 77]}]
+    vehicle_types = None
     max_route_time = 2700    # 45 minutes in seconds for max time per bus for their routes
+    workers = 1              # number of schools solved at once, 1 solves them one after another
+    export_route_csvs = True # write Tier*\\SCHOOL_pmRouteData.csv for every school
+    chaining = 'matching'    # 'matching' for min-cost matching of buses to routes, 'greedy' for nearest school,
+                             # 'joint' for one model of all tiers with bell times
+    bell_times = None        # seconds at which each tier's routes leave school for the joint engine,
+                             # e.g. [0, 3000, 6000]; None for tiers max_route_time apart
+    compare_chaining_engines = False  # also chain with every other engine and print how they compare
+    clear_solve_cache = False  # forget every cached school before solving
+    run_budget = None        # seconds of search shared by all schools of the run, None for no limit
+    metrics_file = None      # append phase timings and solver statistics to this JSON lines file, None to disable
+    travel_times = 'heuristic' # deadhead times: 'heuristic' for the geodesic estimate, 'road:roads.csv' for
+                             # shortest paths over a road network file, see travel_time.py
+    travel_time_cache = None # keep the deadhead times in this sqlite file, e.g. 'travel_times.sqlite'
+    options = dict(SOLVE_OPTIONS,
+                   engine='matrix',         # 'matrix' for native arc evaluation, 'callback' for Python callbacks
+                   fleet_sizing=True,       # model each school with only as many buses as it is likely to need
+                   cache_dir='solve_cache', # reuse routes of schools whose inputs did not change, None to always solve
+                   warm_start=False,        # start each school from the routes of the last run's SCHOOL_pmRouteData.csv
+                   warm_start_time_limit=10,  # seconds of search for a warm-started school instead of 100
+                   time_policy='fixed',     # 'scaled' to give small schools less than time_limit seconds
+                   time_limit=100,
+                   stall_seconds=None,      # stop a school after this many seconds without improving by
+                   min_improvement=0.005,   # this fraction of its objective, None to never stop early
+                   neighbors=None,          # k to keep only arcs to each stop's k nearest stops, None for all arcs
+                   max_cluster_size=None,   # split schools with more stops into clusters of at most this many
+                   cluster_workers=1,       # number of clusters of a school solved at once
+                   repair_time_limit=10,    # seconds of search for each pair of neighbouring clusters
+                   portfolio=0,             # race this many search configurations per school on their own cores
+                   portfolio_history='portfolio_history',  # learn which configuration wins each school
+                   metrics=open_sink(metrics_file))
     school_codes = [['JHS', 'LHS', 'WHS','TMS'],
                     ['HMS', 'JBM', 'BMS', 'DJM', 'JR', 'SH'],
                     ['MAT', 'MW', 'CBB', 'LL', 'NES', 'JBB']]
     buses_used = {}
 
     ################### FInd Optimized Routes per School ########################
-    # iterate through each tier to find optimum routes for each school
+    # every school gets the whole fleet to choose from, so the schools of a tier
+    # can be solved independently and in parallel
     start_time = datetime.datetime.now()
+    metrics = options['metrics']
+    if clear_solve_cache and options['cache_dir'] is not None:
+        clear_cache(options['cache_dir'])
+    stops_data = {}
+    for tier in range(1,tiers+1):
+        with metrics.phase('parse', tier=tier):
+            stops_data[tier] = load_tier_data(tier)
+    schools = [(tier, school) for tier in range(1,tiers+1) for school in school_codes[tier-1]]
+    buses_avail = [bus_capacity for i in range(numBuses)]
+    fleets = None
+    if vehicle_types is not None:
+        # share the buses of each type among the schools of a tier
+        numBuses = sum(vehicle_type['count'] for vehicle_type in vehicle_types)
+        school_students = {school: int(-stops_data[tier][stops_data[tier][:, 4] == school][:, 7].sum())
+                           for tier, school in schools}
+        quotas = plan_quotas(vehicle_types, school_codes, school_students)
+        fleets = {school: quota_fleet(vehicle_types, quotas[school], tier) for tier, school in schools}
+    with metrics.phase('solve_schools', schools=len(schools), workers=workers):
+        solved = solve_schools(schools, stops_data, buses_avail, max_route_time, options, workers, run_budget,
+                               fleets)
+        if vehicle_types is not None:
+            solved = solve_short_schools(schools, solved, stops_data, vehicle_types, quotas, max_route_time,
+                                         options)
+    for (tier, school), opt_routes in zip(schools, solved):
+        routes[school] = build_routes(opt_routes, tier, school, stops_data[tier])
+        if vehicle_types is not None:
+            # a bus keeps its type in every tier, so chaining only links routes of one type
+            type_routes(routes[school], vehicle_types, quotas[school], tier)
+        buses_used[school] = len(opt_routes)
+
+    # schools in the same tier share the fleet
     for tier in range(1,tiers+1):
-        print('\nStarting Tier '+str(tier)+'...')
-        stops_data = load_tier_data(tier)
-        buses_avail = [bus_capacity for i in range(numBuses)]
-        for school in school_codes[tier-1]:
-            print('\nOptimizing routes for ' + school + '...')
-            opt_routes = []
-            buses_used_counter = []
-            data = create_data_model(school, 'Tier'+str(tier)+'\\'+school+'_pmDistance.csv', stops_data)
-            main(data)
-            output_routes(opt_routes, tier, school, stops_data)
-            routes[school] = opt_routes
-            buses_used[school] = sum(buses_used_counter)
+        tier_buses = sum(buses_used[school] for school in school_codes[tier-1])
+        if tier_buses > numBuses:
+            print('\nWarning: Tier {} needs {} buses but only {} are available'.format(tier, tier_buses, numBuses))
 
     end_time = datetime.datetime.now()
     print('\nTime to Compute:', end_time-start_time)
     for school, count in buses_used.items():
         print('{} used {} buses'.format(school, count))
+        metrics.record('school', tier=which_tier(school, school_codes), school=school, buses=count,
+                       route_time=sum(route.time for route in routes[school]))
+
+    # route files are written in the background while buses are assigned
+    route_exports = export_routes(routes, school_codes) if export_route_csvs else []
 
     ################### Assign Buses to Routes ################################
-    bus_routes = {i:[] for i in range(numBuses)}
-    # assign buses to tier 1 school routes
-    bus_counter = 0
-    for school in school_codes[0]:
-        for i in range(buses_used[school]):
-            buses_used[school] -= 1
-            route =  buses_used[school]
-            bus_routes[bus_counter].append([school, route, routes[school][route][1]])
-            bus_counter += 1
-
-    # calculate distance dictionary, [tier, school, route]: tuples of (next school, distances)
-    distances = {}
-    for tier in range(1,tiers):
-        for school in school_codes[tier-1]:
-            route_data = pd.read_csv('Tier'+str(tier)+'\\'+school+'_pmRouteData.csv', delimiter=',')
-            route_data = route_data.values
-            # gets the row of the last stop per route
-            last_stops = [route_data[row] for row in range(len(route_data)) if row+1 == len(route_data) or route_data[row+1][0] != route_data[row][0]]
-            # iterate through the buses needed for this school and assign routes
-            for stop in last_stops:
-                # distances is a list of tuples (school, distance, next_tier)
-                distances[(tier, school, stop[0])] = calc_distances((stop[1], stop[2]), tier+1)
-
-    # assign buses to tier 2 and 3 school routes based on distances from last stops of tier 1 and 2
-    bus_counter = 0
-    for tier in range(2,tiers+1):
-        for bus, assignments in bus_routes.items():
-            if len(assignments) == 0:
-                bus_counter = bus
-                break
-
-            school = assignments[len(assignments)-1][0]
-            route = assignments[len(assignments)-1][1]
-
-            if len(assignments)==1 and tier == 2:
-                dists = [dist for dist in distances[(1, school, route)] if dist[2]==tier]
-            elif len(assignments)==1 and tier == 3:
-                dists = [dist for dist in distances[(which_tier(school), school, route)] if dist[2]==tier]
-            else:
-                dists = distances[(2, school, route)]
-
-            for i in range(len(dists)):
-                if buses_used[dists[i][0]] > 0:
-                    next_school = dists[i][0]
-                    duration = (dists[i][1]*1.536)//13    # 1.536 is avg factor to convert from euclidean to google maps distance
-                                                              # 13 is about the avg velocity of the bus when doing its route
-                    # check to make sure that the bus can make it to the next school on time from its last stop
-                    if bus_routes[bus][len(assignments)-1][2] + duration <= max_route_time or (which_tier(next_school)==3 and which_tier(school)==1):
-                        buses_used[next_school] -= 1
-                        next_route = buses_used[dists[i][0]]
-                        next_route_duration = routes[next_school][next_route][1]
-                        bus_routes[bus][len(assignments)-1][2] += duration
-                        bus_routes[bus].append([next_school, next_route, next_route_duration])
-                        break
-            # keeps track of how many buses have been assigned for each tier
-
-        # checks for unassigned buses and assigns them
-        for school in school_codes[tier-1]:
-            while buses_used[school] > 0:
-                buses_used[school] -= 1
-                bus_routes[bus_counter].append([school, buses_used[school], routes[school][buses_used[school]][1]])
-                bus_counter += 1
+    provider = None if travel_times == 'heuristic' else open_provider(travel_times, travel_time_cache)
+    if compare_chaining_engines:
+        # chain the routes into buses with every engine to see how they compare, keep the chosen one
+        bus_routes, deadhead = compare_chaining(routes, school_codes, max_route_time, numBuses, metrics,
+                                                provider, bell_times)[chaining]
+    else:
+        with metrics.phase('distances'):
+            distances = last_stop_distances(routes, school_codes, provider=provider)
+        with metrics.phase('chaining', engine=chaining) as fields:
+            bus_routes, deadhead = assign_buses(routes, school_codes, max_route_time, numBuses, chaining, distances,
+                                                bell_times=bell_times)
+            fields.update(buses=buses_in_service(bus_routes), deadhead=deadhead)
+        print('Chaining ({}): {} buses, {}sec of deadhead'.format(chaining, buses_in_service(bus_routes), deadhead))
 
     # print(bus_routes)
     # print(buses_used)
@@ -322,7 +619,13 @@ if __name__ == '__main__':
             school = assignments[i][0]
             route = assignments[i][1]
             duration = assignments[i][2]
-            output.append([bus, school, route, duration, routes[school][route][2]])
-
-    output_df = pd.DataFrame(output, columns=['bus', 'school', 'route', 'duration', 'load'])
-    output_df.to_csv('bus_assignments.csv', index=False)
\ No newline at end of file
+            output.append([bus, school, route, duration, routes[school][route].load,
+                           routes[school][route].vehicle_type])
+
+    output_df = pd.DataFrame(output, columns=['bus', 'school', 'route', 'duration', 'load', 'type'])
+    output_df.to_csv('bus_assignments.csv', index=False)
+    with metrics.phase('export', schools=len(route_exports)):
+        for export in route_exports:
+            export.result()
+    metrics.record('run', wall_time=(datetime.datetime.now()-start_time).total_seconds(),
+                   buses=buses_in_service(bus_routes), deadhead=deadhead)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Portfolio search: several search configurations race on the same school.
+
+Each configuration is a first solution strategy and a local search metaheuristic.
+The configurations run at the same time in their own worker processes (the solver
+holds the GIL while it searches, so threads would take turns on one core), each with
+the school's time limit, and all of them are cancelled through one shared event as
+soon as one reaches the target objective. The best routes win.
+
+Which configuration won is recorded per school in history_dir/SCHOOL.json, along
+with the best objective seen. Later portfolios race the configurations that won
+most often first and take that objective as their target, and a run without a
+portfolio solves each school with the configuration that has won it most often.
+"""
+
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from ortools.constraint_solver import routing_enums_pb2
+
+# configurations in the order they are tried when a school has no history;
+# the first is the search pm_new has always used
+PORTFOLIO = [{'name': 'path_cheapest_arc', 'first_solution': 'PATH_CHEAPEST_ARC', 'metaheuristic': None},
+             {'name': 'path_cheapest_arc_gls', 'first_solution': 'PATH_CHEAPEST_ARC',
+              'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+             {'name': 'parallel_cheapest_insertion_gls', 'first_solution': 'PARALLEL_CHEAPEST_INSERTION',
+              'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+             {'name': 'savings_annealing', 'first_solution': 'SAVINGS', 'metaheuristic': 'SIMULATED_ANNEALING'},
+             {'name': 'christofides_tabu', 'first_solution': 'CHRISTOFIDES', 'metaheuristic': 'TABU_SEARCH'}]
+
+# copy of search_parameters with the strategy and metaheuristic of config
+def config_parameters(search_parameters, config):
+    parameters = type(search_parameters)()
+    parameters.CopyFrom(search_parameters)
+    parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, config['first_solution'])
+    if config['metaheuristic'] is not None:
+        parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic,
+                                                        config['metaheuristic'])
+    return parameters
+
+def _history_path(history_dir, school):
+    return os.path.join(history_dir, str(school) + '.json')
+
+# {'wins': {name: count}, 'best_objective': objective} of a school, empty without history
+def load_history(history_dir, school):
+    if history_dir is None or school is None:
+        return {}
+    try:
+        with open(_history_path(history_dir, school), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+# count a win for winner and keep the best objective; each school has its own file, so
+# schools solved in parallel processes never write the same one
+def record_win(history_dir, school, winner, objective):
+    if history_dir is None or school is None:
+        return
+    history = load_history(history_dir, school)
+    wins = history.setdefault('wins', {})
+    wins[winner] = wins.get(winner, 0) + 1
+    if history.get('best_objective') is None or objective < history['best_objective']:
+        history['best_objective'] = objective
+    os.makedirs(history_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=history_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, _history_path(history_dir, school))
+
+# configurations by how often they won the school, the portfolio order on ties
+def ranked_configs(history, configs=PORTFOLIO):
+    wins = history.get('wins', {})
+    return sorted(configs, key=lambda config: -wins.get(config['name'], 0))
+
+def total_time(opt_routes):
+    return sum(route[1] for route in opt_routes)
+
+# event that cancels every configuration of the portfolio a worker process races in;
+# a multiprocessing.Event can only be handed to a process when it starts
+_cancel = None
+
+def init_worker(cancel):
+    global _cancel
+    _cancel = cancel
+
+# one configuration of a portfolio in a worker process
+def run_config(solve, data, options, search_parameters, config, target_objective):
+    config_options = dict(options, portfolio=0, cancel=_cancel, target_objective=target_objective)
+    return solve(data, config_options, config_parameters(search_parameters, config))
+
+# race the size best ranked configurations on data with solve(data, options,
+# search_parameters) (pm_new.solve_data), one worker process each, and return the best routes
+def solve_portfolio(data, solve, options, search_parameters, size, history_dir=None, target_objective=None):
+    school = data.get('school')
+    history = load_history(history_dir, school)
+    configs = ranked_configs(history)[:max(1, size)]
+    if target_objective is None:
+        target_objective = history.get('best_objective')
+    cancel = multiprocessing.Event()
+    # the workers are cancelled by the portfolio's own event
+    options = dict(options, cancel=None)
+
+    with ProcessPoolExecutor(max_workers=len(configs), initializer=init_worker, initargs=(cancel,)) as executor:
+        solved = list(executor.map(run_config, [solve for config in configs], [data for config in configs],
+                                   [options for config in configs], [search_parameters for config in configs],
+                                   configs, [target_objective for config in configs]))
+
+    found = [i for i, opt_routes in enumerate(solved) if opt_routes]
+    if not found:
+        return []
+    winner = min(found, key=lambda i: (total_time(solved[i]), i))
+    print('Portfolio: {} won with {}sec of routes ({})'.format(
+        configs[winner]['name'], total_time(solved[winner]),
+        ', '.join('{} {}'.format(config['name'], total_time(opt_routes) if opt_routes else 'none')
+                  for config, opt_routes in zip(configs, solved))))
+    record_win(history_dir, school, configs[winner]['name'], total_time(solved[winner]))
+    return solved[winner]
+
+# search_parameters with the configuration that won the school most often
+def default_parameters(search_parameters, school, history_dir):
+    history = load_history(history_dir, school)
+    if not history.get('wins'):
+        return search_parameters
+    return config_parameters(search_parameters, ranked_configs(history)[0])
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory store of the optimized routes of every school.
+
+The bus assignment phase reads the routes straight from the store instead of
+writing Tier*\\SCHOOL_pmRouteData.csv and reading it back. The CSV files are an
+optional export, written on background threads while the assignment runs.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+
+@dataclass
+class Route:
+    school: str
+    tier: int
+    route: int               # route number within the school
+    stops: np.ndarray        # node index of each stop, starting with the school
+    names: np.ndarray        # stop names from Tier*_pm.csv
+    latitude: np.ndarray
+    longitude: np.ndarray
+    students: np.ndarray     # students dropped off at each stop
+    time: int                # seconds to drive the route
+    load: int                # students on the bus
+    vehicle_type: str = None # type of bus that drives the route with a mixed fleet, see fleet.type_routes
+
+    # (latitude, longitude) of the stop where the bus finishes the route
+    @property
+    def last_stop(self):
+        return (self.latitude[-1], self.longitude[-1])
+
+# turn the [route, route_time, route_load] lists of a school's solution into Routes
+def build_routes(opt_routes, tier, school, stops_data):
+    stops_data = stops_data[stops_data[:, 4] == school]
+    routes = []
+    for i, (route, route_time, route_load) in enumerate(opt_routes):
+        stops = np.array([stop for stop, students in route], dtype=int)
+        routes.append(Route(school=school,
+                            tier=tier,
+                            route=i,
+                            stops=stops,
+                            names=stops_data[stops, 5],
+                            latitude=stops_data[stops, 1],
+                            longitude=stops_data[stops, 0],
+                            students=np.array([students for stop, students in route]),
+                            time=route_time,
+                            load=route_load))
+    return routes
+
+# table of a school's routes in the layout of SCHOOL_pmRouteData.csv
+def route_table(routes):
+    routeDict = {'route': [],
+                 'latitude': [],
+                 'longitude': [],
+                 'stop name': [],
+                 'count': [],
+                 'order': []}
+    for route in routes:
+        routeDict['route'].extend([route.route] * len(route.stops))
+        routeDict['latitude'].extend(route.latitude)
+        routeDict['longitude'].extend(route.longitude)
+        routeDict['stop name'].extend(route.names)
+        routeDict['count'].extend(-1 * route.students)
+        routeDict['order'].extend(range(1, len(route.stops)+1))
+    return pd.DataFrame(routeDict)
+
+# save one school's routes to an external csv file
+def write_route_table(routes, filename):
+    route_table(routes).to_csv(filename, index=False)
+
+# write Tier*\\SCHOOL_pmRouteData.csv (or _amRouteData.csv for period 'am') for every
+# school on background threads; returns the futures of the writes, whose result() waits for the file
+def export_routes(routes, school_codes, workers=4, period='pm'):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    for tier, schools in enumerate(school_codes, 1):
+        for school in schools:
+            filename = 'Tier'+str(tier)+'\\'+school+'_'+period+'RouteData.csv'
+            futures.append(executor.submit(write_route_table, routes[school], filename))
+    executor.shutdown(wait=False)
+    return futures
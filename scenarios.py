@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep of tier layouts, bus capacities and maximum route times.
+
+Every combination of a tier layout (school_codes), a bus_capacity and a
+max_route_time is one scenario. Each tier's stops and each school's matrix are
+read once. A school's routes do not depend on the tier it is in, so a school is
+solved once per (bus_capacity, max_route_time) and shared by every layout; those
+solves and the bus chaining of every scenario run in parallel. The buses needed and
+total route time of each scenario are printed and written to scenario_comparison.csv.
+
+Files are read from the Tier* folders of the current layout (file_codes), wherever
+a scenario puts the school.
+"""
+
+import itertools
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import pm_new
+from route_store import build_routes
+from bus_chaining import assign_buses, buses_in_service, which_tier
+
+# every combination of layouts ({name: school_codes}), bus capacities and max route times
+def make_scenarios(layouts, bus_capacities, max_route_times):
+    return [{'layout': name, 'school_codes': layouts[name], 'bus_capacity': bus_capacity,
+             'max_route_time': max_route_time}
+            for name, bus_capacity, max_route_time in itertools.product(layouts, bus_capacities, max_route_times)]
+
+# data model of every school, with its matrix read once; {school: data}
+def load_schools(file_codes, num_buses, bus_capacity, max_route_time):
+    stops_data = {tier: pm_new.load_tier_data(tier) for tier in range(1,len(file_codes)+1)}
+    data = {}
+    for tier, schools in enumerate(file_codes, 1):
+        for school in schools:
+            data[school] = pm_new.create_data_model(school, 'Tier'+str(tier)+'\\'+school+'_pmDistance.csv',
+                                                    stops_data[tier], [bus_capacity for i in range(num_buses)],
+                                                    max_route_time)
+    return stops_data, data
+
+# the school's data model with another bus capacity and max route time; the matrices are shared
+def with_limits(data, bus_capacity, max_route_time):
+    variant = dict(data)
+    variant['vehicle_capacities'] = [bus_capacity for i in range(data['num_vehicles'])]
+    variant['max_route_time'] = max_route_time
+    return variant
+
+def solve_variant(data, options):
+    time_limit = pm_new.school_time_limit(len(data['students'])-1, options)
+    return pm_new.solve_cached(data, options, pm_new.create_search_parameters(time_limit))
+
+# chain one scenario's routes into buses and sum up its results
+def assign_scenario(scenario, routes, num_buses, chaining):
+    school_codes = scenario['school_codes']
+    bus_routes, deadhead = assign_buses(routes, school_codes, scenario['max_route_time'], num_buses, chaining)
+    tier_routes = [sum(len(routes[school]) for school in schools) for schools in school_codes]
+    return dict(layout=scenario['layout'],
+                bus_capacity=scenario['bus_capacity'],
+                max_route_time=scenario['max_route_time'],
+                buses=buses_in_service(bus_routes),
+                most_routes_in_a_tier=max(tier_routes),
+                routes=sum(tier_routes),
+                route_time=int(sum(route.time for school_routes in routes.values() for route in school_routes)),
+                deadhead=float(deadhead))
+
+# run every scenario; file_codes is the layout the Tier* folders are in
+def run_scenarios(file_codes, scenarios, num_buses=97, options=None, workers=1, chaining='matching'):
+    options = dict(pm_new.SOLVE_OPTIONS, **(options or {}))
+    stops_data, base = load_schools(file_codes, num_buses, scenarios[0]['bus_capacity'],
+                                    scenarios[0]['max_route_time'])
+    file_tier = {school: tier for tier, schools in enumerate(file_codes, 1) for school in schools}
+
+    # each school once per bus capacity and max route time
+    limits = sorted(set((scenario['bus_capacity'], scenario['max_route_time']) for scenario in scenarios))
+    jobs = [(school, bus_capacity, max_route_time) for bus_capacity, max_route_time in limits for school in base]
+    print('{} scenarios, {} school solves instead of {}'.format(
+        len(scenarios), len(jobs), len(scenarios) * len(base)))
+    variants = [with_limits(base[school], bus_capacity, max_route_time)
+                for school, bus_capacity, max_route_time in jobs]
+    if workers <= 1:
+        solved = [solve_variant(variant, options) for variant in variants]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            solved = list(executor.map(solve_variant, variants, [options for variant in variants]))
+    solutions = {job: opt_routes for job, opt_routes in zip(jobs, solved)}
+
+    scenario_routes = []
+    for scenario in scenarios:
+        routes = {}
+        for schools in scenario['school_codes']:
+            for school in schools:
+                opt_routes = solutions[(school, scenario['bus_capacity'], scenario['max_route_time'])]
+                routes[school] = build_routes(opt_routes, which_tier(school, scenario['school_codes']), school,
+                                              stops_data[file_tier[school]])
+        scenario_routes.append(routes)
+
+    args = (scenarios, scenario_routes, [num_buses for s in scenarios], [chaining for s in scenarios])
+    if workers <= 1:
+        results = list(map(assign_scenario, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(assign_scenario, *args))
+    return pd.DataFrame(results)
+
+if __name__ == '__main__':
+    numBuses = 97
+    workers = 4              # number of schools (and then scenarios) solved at once
+    chaining = 'matching'    # engine that chains the routes into buses, see bus_chaining.py
+    # the layout the Tier* folders are in
+    school_codes = [['JHS', 'LHS', 'WHS','TMS'],
+                    ['HMS', 'JBM', 'BMS', 'DJM', 'JR', 'SH'],
+                    ['MAT', 'MW', 'CBB', 'LL', 'NES', 'JBB']]
+    # layouts to compare
+    layouts = {'current': school_codes,
+               'TMS tier 2': [['JHS', 'LHS', 'WHS'],
+                              ['HMS', 'JBM', 'BMS', 'DJM', 'JR', 'SH', 'TMS'],
+                              ['MAT', 'MW', 'CBB', 'LL', 'NES', 'JBB']],
+               'TMS tier 2, JR tier 3': [['JHS', 'LHS', 'WHS'],
+                                         ['HMS', 'JBM', 'BMS', 'DJM', 'SH', 'TMS'],
+                                         ['MAT', 'MW', 'CBB', 'LL', 'NES', 'JBB', 'JR']]}
+    bus_capacities = [54]
+    max_route_times = [2700]  # seconds
+    options = dict(pm_new.SOLVE_OPTIONS,
+                   cache_dir='solve_cache',  # schools solved in an earlier sweep or run are not solved again
+                   time_limit=100)
+
+    scenarios = make_scenarios(layouts, bus_capacities, max_route_times)
+    comparison = run_scenarios(school_codes, scenarios, numBuses, options, workers, chaining)
+    print(comparison.to_string(index=False))
+    comparison.to_csv('scenario_comparison.csv', index=False)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive stopping of the routing search.
+
+Instead of a fixed 100 seconds for every school:
+scaled_time_limit -> a time limit that grows with the number of stops of the school
+SearchMonitor     -> records the objective of every improving solution and stops the
+                     search once it has not improved by min_improvement within stall_seconds,
+                     or when cancel (a threading.Event) is set, which it sets itself once
+                     the objective reaches target_objective
+RunBudget         -> a wall-clock budget shared by all schools of a run; time a school
+                     does not use is shared among the schools still to be solved
+"""
+
+import math
+import time
+
+# seconds of search for a school with num_stops stops
+def scaled_time_limit(num_stops, base=5, per_stop=0.5, maximum=100):
+    return int(min(maximum, math.ceil(base + per_stop * num_stops)))
+
+class SearchMonitor:
+    # attach to a routing model before solving it
+    def __init__(self, routing, stall_seconds=None, min_improvement=0.0, cancel=None, target_objective=None):
+        self.routing = routing
+        self.stall_seconds = stall_seconds
+        self.min_improvement = min_improvement
+        self.cancel = cancel
+        self.target_objective = target_objective
+        self.start_time = time.time()
+        self.trajectory = []            # (seconds, objective) of every improving solution
+        self.reference = None           # objective of the last big enough improvement
+        self.last_improvement = None    # when that improvement was found
+        routing.AddAtSolutionCallback(self.on_solution)
+        self.limit = None
+        if stall_seconds is not None or cancel is not None:
+            self.limit = routing.solver().CustomLimit(self.stalled)
+            routing.AddSearchMonitor(self.limit)
+
+    def on_solution(self):
+        objective = self.routing.CostVar().Value()
+        now = time.time()
+        if self.trajectory and objective >= self.trajectory[-1][1]:
+            return
+        self.trajectory.append((round(now - self.start_time, 3), objective))
+        if self.reference is None or objective <= self.reference * (1 - self.min_improvement):
+            self.reference = objective
+            self.last_improvement = now
+        if self.cancel is not None and self.target_objective is not None and objective <= self.target_objective:
+            self.cancel.set()
+
+    # the search is stopped when this returns True; never before the first solution
+    # unless it was cancelled
+    def stalled(self):
+        if self.cancel is not None and self.cancel.is_set():
+            return True
+        return (self.stall_seconds is not None and self.last_improvement is not None and
+                time.time() - self.last_improvement > self.stall_seconds)
+
+    def summary(self):
+        if not self.trajectory:
+            return 'no solution found'
+        return '{} improvements, {} -> {} (last after {:.1f}sec)'.format(
+            len(self.trajectory), self.trajectory[0][1], self.trajectory[-1][1], self.trajectory[-1][0])
+
+class RunBudget:
+    # seconds of search for a run of num_schools schools, workers of them solved at once
+    def __init__(self, seconds, num_schools, workers=1):
+        self.deadline = time.time() + seconds
+        self.remaining = num_schools
+        self.workers = max(1, workers)
+
+    # time limit for the next school: its own time_limit, or less when the time left,
+    # spread over the schools still to be solved, does not allow it
+    def allot(self, time_limit):
+        left = max(0.0, self.deadline - time.time())
+        share = left * min(self.workers, self.remaining) / max(1, self.remaining)
+        self.remaining -= 1
+        return max(1, min(time_limit, int(share)))
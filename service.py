@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Local planning service: plans over HTTP on localhost without paying for the imports
+and the CSV parsing on every question.
+
+Every tier's stops are read once when the service starts, and together with every
+school's matrix by each of its worker processes, which stay up between plans.
+A plan request is queued; plans are taken from the queue in order and their
+schools are solved on the warm workers, so repeated what-if questions only pay for
+the search (or nothing, when the solve cache already has the school).
+
+    python service.py                           serves on http://127.0.0.1:8150
+
+POST /plans               {"bus_capacity": 54, "max_route_time": 2700, "num_buses": 97,
+                           "chaining": "matching", "school_codes": [[...], ...],
+                           "options": {"time_limit": 30}}, every field optional;
+                          answers {"job": id} at once
+GET  /plans/ID            status of the plan and every result so far
+GET  /plans/ID/stream     the results as JSON lines while they come: one 'school' line
+                          with its routes as each school finishes, then 'assignment'
+                          with the buses, then 'done' (or 'error')
+GET  /metrics             queue depth, plans running and done, and latency (submitted
+                          to done) and queue wait percentiles of the recent plans
+"""
+
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+import numpy as np
+
+import pm_new
+from ampm import load_inputs
+from route_store import build_routes
+from bus_chaining import CHAINING_ENGINES, assign_buses, buses_in_service, last_stop_distances, which_tier
+from scenarios import with_limits
+from metrics import NULL_SINK, open_sink
+
+DEFAULT_PORT = 8150
+RECENT_PLANS = 1000   # plans kept for the latency percentiles
+SERVICE_OPTIONS = ['cancel', 'metrics']  # solve options the service sets itself, not a request
+
+# data models of every school in a worker process, loaded by its initializer
+_worker_data = {}
+
+# worker initializer: import the solver and read every school once
+def init_worker(directory, school_codes, num_buses, bus_capacity, max_route_time):
+    stops_data, matrices = load_inputs(school_codes, directory)
+    for tier, schools in enumerate(school_codes, 1):
+        for school in schools:
+            _worker_data[school] = pm_new.create_data_model(
+                school, None, stops_data[tier], [bus_capacity for i in range(num_buses)], max_route_time,
+                matrix=matrices[school])
+
+def worker_pid(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+# solve one school of a plan in a worker; opt_routes like pm_new.main
+def solve_job(school, num_buses, bus_capacity, max_route_time, options):
+    data = with_limits(_worker_data[school], bus_capacity, max_route_time)
+    if num_buses != data['num_vehicles']:
+        data.update(num_vehicles=num_buses,
+                    vehicle_capacities=[bus_capacity for i in range(num_buses)],
+                    starts=[0 for i in range(num_buses)],
+                    ends=[data['ends'][0] for i in range(num_buses)])
+    time_limit = pm_new.school_time_limit(len(data['students'])-1, options)
+    return pm_new.solve_cached(data, options, pm_new.create_search_parameters(time_limit))
+
+class Job:
+    def __init__(self, job_id, request):
+        self.id = job_id
+        self.request = request
+        self.status = 'queued'
+        self.events = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.changed = threading.Condition()
+
+    def start(self):
+        with self.changed:
+            self.status = 'running'
+            self.started = time.time()
+            self.changed.notify_all()
+
+    def emit(self, event, **fields):
+        with self.changed:
+            self.events.append(dict(fields, event=event))
+            self.changed.notify_all()
+
+    # the last event, 'done' or 'error', goes in together with the status
+    def finish(self, status, **fields):
+        with self.changed:
+            self.status = status
+            self.finished = time.time()
+            self.events.append(dict(fields, event=status, latency=self.finished - self.submitted))
+            self.changed.notify_all()
+
+    # events from index start on, waiting up to timeout seconds for one when there are
+    # none, and whether they include the last one
+    def events_since(self, start, timeout=None):
+        with self.changed:
+            if len(self.events) <= start and self.status not in ('done', 'error'):
+                self.changed.wait(timeout)
+            return self.events[start:], self.status in ('done', 'error')
+
+    def summary(self):
+        return {'job': self.id, 'status': self.status, 'submitted': self.submitted, 'started': self.started,
+                'finished': self.finished, 'events': list(self.events)}
+
+class PlanningService:
+    # school_codes is the layout of the Tier* folders in directory; a plan may move
+    # schools to other tiers with its own school_codes
+    def __init__(self, school_codes, directory='', workers=4, num_buses=97, bus_capacity=54, max_route_time=2700,
+                 options=None, chaining='matching', concurrent_plans=1, metrics_file=None):
+        self.school_codes = school_codes
+        self.directory = directory
+        self.defaults = {'num_buses': num_buses, 'bus_capacity': bus_capacity, 'max_route_time': max_route_time,
+                         'chaining': chaining, 'school_codes': school_codes}
+        self.options = dict(pm_new.SOLVE_OPTIONS, **(options or {}))
+        self.metrics = open_sink(metrics_file) if metrics_file is not None else NULL_SINK
+        self.stops_data = {tier: pm_new.load_tier_data(tier, directory) for tier in range(1, len(school_codes)+1)}
+        self.file_tier = {school: tier for tier, schools in enumerate(school_codes, 1) for school in schools}
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                            initargs=(directory, school_codes, num_buses, bus_capacity,
+                                                      max_route_time))
+        # give every worker a task so all of them start and read their data now
+        pids = set(self.executor.map(worker_pid, [0.5 for i in range(workers)]))
+        print('Planning service warm: {} worker processes, {} schools'.format(len(pids), len(self.file_tier)))
+
+        self.jobs = {}
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=RECENT_PLANS)
+        self.queue_waits = deque(maxlen=RECENT_PLANS)
+        for i in range(concurrent_plans):
+            threading.Thread(target=self.dispatch, daemon=True).start()
+
+    # raise ValueError for a field of a plan request the service cannot plan with
+    def validate(self, request):
+        for name in ['num_buses', 'bus_capacity', 'max_route_time']:
+            value = request.get(name, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                raise ValueError('{} must be a positive integer, not {!r}'.format(name, value))
+        school_codes = request.get('school_codes', [])
+        if not (isinstance(school_codes, list) and
+                all(isinstance(schools, list) and all(isinstance(school, str) for school in schools)
+                    for schools in school_codes)):
+            raise ValueError('school_codes must be a list of lists of school codes, not {!r}'.format(school_codes))
+        unknown = [school for schools in school_codes for school in schools if school not in self.file_tier]
+        if unknown:
+            raise ValueError('Unknown schools {}'.format(unknown))
+        if request.get('chaining', 'matching') not in CHAINING_ENGINES:
+            raise ValueError('chaining must be one of {}, not {!r}'.format(list(CHAINING_ENGINES),
+                                                                           request['chaining']))
+        options = request.get('options', {})
+        if not isinstance(options, dict):
+            raise ValueError('options must be an object, not {!r}'.format(options))
+        unknown = [name for name in options if name not in pm_new.SOLVE_OPTIONS or name in SERVICE_OPTIONS]
+        if unknown:
+            raise ValueError('Unknown options {}'.format(unknown))
+
+    def submit(self, request):
+        self.validate(request)
+        with self.lock:
+            job = Job(next(self.ids), dict(self.defaults, **request))
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def dispatch(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                self.running += 1
+            job.start()
+            try:
+                self.plan(job)
+                job.finish('done')
+            except Exception as error:
+                job.finish('error', message=str(error))
+            with self.lock:
+                self.running -= 1
+                self.completed += job.status == 'done'
+                self.failed += job.status == 'error'
+                self.latencies.append(job.finished - job.submitted)
+                self.queue_waits.append(job.started - job.submitted)
+            self.metrics.record('plan', job=job.id, status=job.status, latency=job.finished - job.submitted,
+                                queue_wait=job.started - job.submitted)
+
+    # solve the schools of a plan on the workers, emitting each as it finishes, then chain them
+    def plan(self, job):
+        request = job.request
+        school_codes = request['school_codes']
+        options = dict(self.options, **request.get('options', {}))
+        options['metrics'] = None
+        futures = {}
+        for schools in school_codes:
+            for school in schools:
+                futures[self.executor.submit(solve_job, school, request['num_buses'], request['bus_capacity'],
+                                             request['max_route_time'], options)] = school
+
+        routes = {}
+        for future in as_completed(futures):
+            school = futures[future]
+            tier = which_tier(school, school_codes)
+            routes[school] = build_routes(future.result(), tier, school, self.stops_data[self.file_tier[school]])
+            job.emit('school', school=school, tier=tier, buses=len(routes[school]),
+                     routes=[{'route': route.route, 'time': int(route.time), 'load': int(route.load),
+                              'stops': [str(name) for name in route.names]} for route in routes[school]])
+
+        distances = last_stop_distances(routes, school_codes, os.path.join(self.directory, 'school_locations.csv'))
+        bus_routes, deadhead = assign_buses(routes, school_codes, request['max_route_time'], request['num_buses'],
+                                            request['chaining'], distances)
+        job.emit('assignment', buses=buses_in_service(bus_routes), deadhead=float(deadhead),
+                 assignments=[[int(bus), school, int(route), float(duration), int(routes[school][route].load)]
+                              for bus, assignments in bus_routes.items()
+                              for school, route, duration in assignments])
+
+    def status(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            queue_waits = np.array(self.queue_waits)
+            return {'queue_depth': self.queue.qsize(), 'running': self.running, 'completed': self.completed,
+                    'failed': self.failed, 'latency': percentiles(latencies),
+                    'queue_wait': percentiles(queue_waits)}
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+# count, mean and percentiles in seconds of recent values
+def percentiles(values):
+    if len(values) == 0:
+        return {'count': 0}
+    return {'count': int(len(values)), 'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+class PlanningHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job(self, parts):
+        try:
+            return self.server.service.jobs[int(parts[1])]
+        except (IndexError, KeyError, ValueError):
+            self.send_json({'error': 'no such plan'}, 404)
+            return None
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/plans':
+            return self.send_json({'error': 'not found'}, 404)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError('A plan request must be a JSON object')
+            job = self.server.service.submit(request)
+        except ValueError as error:
+            return self.send_json({'error': str(error)}, 400)
+        self.send_json({'job': job.id}, 202)
+
+    def do_GET(self):
+        parts = [part for part in self.path.split('/') if part]
+        if parts == ['metrics']:
+            return self.send_json(self.server.service.status())
+        if len(parts) == 2 and parts[0] == 'plans':
+            job = self.job(parts)
+            if job is not None:
+                self.send_json(job.summary())
+        elif len(parts) == 3 and parts[0] == 'plans' and parts[2] == 'stream':
+            job = self.job(parts)
+            if job is not None:
+                self.stream(job)
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    # send the events of a job as chunked JSON lines until it is done
+    def stream(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        sent = 0
+        finished = False
+        while not finished:
+            events, finished = job.events_since(sent, timeout=1)
+            for event in events:
+                line = (json.dumps(event) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            self.wfile.flush()
+            sent += len(events)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(service, port=DEFAULT_PORT, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), PlanningHandler)
+    server.daemon_threads = True
+    server.service = service
+    print('Serving plans on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local planning service')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--directory', default='', help='folder with the Tier* folders and school_locations.csv')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes solving schools')
+    parser.add_argument('--time-limit', type=int, default=100, help='seconds of search per school')
+    parser.add_argument('--metrics', default=None, help='append a record of every plan to this JSON lines file')
+    args = parser.parse_args()
+
+    school_codes = [['JHS', 'LHS', 'WHS','TMS'],
+                    ['HMS', 'JBM', 'BMS', 'DJM', 'JR', 'SH'],
+                    ['MAT', 'MW', 'CBB', 'LL', 'NES', 'JBB']]
+    options = dict(pm_new.SOLVE_OPTIONS,
+                   cache_dir=os.path.join(args.directory, 'solve_cache'),  # a what-if already answered is not solved again
+                   time_limit=args.time_limit)
+    service = PlanningService(school_codes, args.directory, workers=args.workers, options=options,
+                              metrics_file=args.metrics)
+    serve(service, args.port)
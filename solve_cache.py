@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of solved schools.
+
+A school's optimized routes are stored under a hash of everything that goes into
+its model: students per stop, time matrix, bus capacities, max_route_time and the
+search parameters. A school whose inputs did not change since an earlier run gets
+its routes back without being solved again. The least recently used entries are
+evicted once the cache grows past its size limit.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import numpy as np
+
+CACHE_DIR = 'solve_cache'
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# content hash of a school's data model and the settings it is solved with
+def cache_key(data, search_parameters, **settings):
+    h = hashlib.sha256()
+    h.update(json.dumps([data['students'], list(data['vehicle_capacities']), data['max_route_time'],
+                         sorted(settings.items())]).encode())
+    if data.get('vehicle_costs') is not None:
+        h.update(json.dumps([int(cost) for cost in data['vehicle_costs']]).encode())
+    h.update(np.ascontiguousarray(data['time_matrix'], dtype=np.int64).tobytes())
+    h.update(search_parameters.SerializeToString(deterministic=True))
+    return h.hexdigest()
+
+def _entry_path(key, cache_dir):
+    return os.path.join(cache_dir, key + '.pkl')
+
+# stored routes for key, or None when the school has not been solved with these inputs
+def load_routes(key, cache_dir=CACHE_DIR):
+    path = _entry_path(key, cache_dir)
+    try:
+        with open(path, 'rb') as f:
+            opt_routes = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+    # mark the entry as recently used
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return opt_routes
+
+# store the routes for key, then evict old entries past max_bytes
+def store_routes(key, opt_routes, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so parallel workers never read half an entry
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(opt_routes, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, _entry_path(key, cache_dir))
+    evict(cache_dir, max_bytes)
+
+# remove the least recently used entries until the cache fits in max_bytes
+def evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+# invalidate the whole cache
+def clear_cache(cache_dir=CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl') or name.endswith('.tmp'):
+            os.remove(os.path.join(cache_dir, name))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Route times reported by pm_new.main, checked against the time matrix.
+
+Run with: python -m pytest -q test_pm_new.py
+"""
+
+import numpy as np
+import pm_new
+
+# a school (node 0, and again as the last node) with six stops on a line
+def line_school(vehicle_costs):
+    positions = [0, 100, 200, 300, 400, 500, 600, 0]
+    time_matrix = np.array([[abs(a - b) for b in positions] for a in positions], dtype=np.int64)
+    students = [0, 10, 10, 10, 10, 10, 10, 0]
+    num_vehicles = len(vehicle_costs)
+    return {'school': 'TEST',
+            'students': students,
+            'time_matrix': time_matrix,
+            'num_vehicles': num_vehicles,
+            'vehicle_capacities': [30] * num_vehicles,
+            'vehicle_costs': vehicle_costs,
+            'max_route_time': 2700,
+            'starts': [0] * num_vehicles,
+            'ends': [len(positions) - 1] * num_vehicles}
+
+# time of a route summed along the time matrix, up to the end node of the bus
+def matrix_time(data, route):
+    nodes = [node for node, students in route] + [data['ends'][0]]
+    return sum(int(data['time_matrix'][a][b]) for a, b in zip(nodes, nodes[1:]))
+
+# the fixed cost of a bus is part of the objective but not of the time of its route
+def test_route_time_excludes_vehicle_cost():
+    data = line_school([1000, 1000, 1000])
+    options = {'fleet_sizing': False}
+    opt_routes = pm_new.main(data, options, pm_new.create_search_parameters(1))
+    assert len(opt_routes) == 2
+    for route, route_time, route_load in opt_routes:
+        assert route_time == matrix_time(data, route)
+        assert route_time <= data['max_route_time']
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Travel times between places, from a pluggable provider.
+
+A place is a Place(id, latitude, longitude); the id is the stop or school name.
+Every provider answers one_to_many(origin, destinations) with the road distances
+(meters) and driving times (seconds) from one place to a batch of places, and
+many_to_many with one such row per origin:
+
+HeuristicProvider -> the estimate the planner always used: geodesic distance times
+                     DETOUR_FACTOR, driven at BUS_SPEED
+MatrixProvider    -> a school's precomputed SCHOOL_pmDistance.csv matrix (or its
+                     binary store), looked up by stop id
+RoadGraphProvider -> shortest paths over an offline road network file, one Dijkstra
+                     per origin that stops once every destination is settled; places
+                     are snapped to the nearest node through a grid of the nodes
+
+CachedProvider wraps any of them with a persistent least recently used cache of
+place pairs in an sqlite3 file, so pairs asked once are never computed again in
+later runs; the origins with pairs missing from the cache go to the provider in
+one many_to_many call. The name of a provider that reads a file carries the file's
+modification time and size, so the pairs of a file written again are asked again
+and the cached pairs of its older versions are dropped. build_planes makes the stop to stop planes of a school's
+model with a provider, so new stops need no matrix from outside the planner.
+
+The road network file is a CSV of directed edges with the columns
+from,from_lat,from_lon,to,to_lat,to_lon,length,time,oneway (length in meters, time
+in seconds; an edge with oneway 0 is driven both ways), e.g. exported from
+OpenStreetMap.
+"""
+
+import heapq
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+from bus_chaining import DETOUR_FACTOR, BUS_SPEED
+from distance_matrix import load_school_matrix, open_matrix_store, matrix_store_paths
+from geodesic import geodesic_distances
+
+Place = namedtuple('Place', ['id', 'latitude', 'longitude'])
+
+CACHE_PAIRS = 1000000   # pairs kept in a cache file before the least recently used are dropped
+CACHE_RECENT = 100      # calls after which a pair found in the cache is marked used again
+GRID_CELL = 0.01        # degrees of latitude and longitude per cell of the road network's node grid
+METERS_PER_DEGREE = 110000  # a little less than the meters in a degree of latitude anywhere
+SQL_PARAMETERS = 900    # sqlite takes at most 999 parameters in a query
+
+# modification time and size of each of filenames that exists, to tell the versions of
+# a file apart
+def file_version(*filenames):
+    stats = [os.stat(filename) for filename in filenames if os.path.isfile(filename)]
+    return ','.join('{}-{}'.format(stat.st_mtime_ns, stat.st_size) for stat in stats)
+
+# places of rows of Tier*_pm.csv
+def places_of(stops):
+    return [Place(str(row[5]), float(row[1]), float(row[0])) for row in stops]
+
+class TravelTimeProvider:
+    name = 'provider'
+
+    # (distances, times) arrays from origin to each of destinations
+    def one_to_many(self, origin, destinations):
+        raise NotImplementedError
+
+    # (distances, times) matrices with a row per origin
+    def many_to_many(self, origins, destinations):
+        rows = [self.one_to_many(origin, destinations) for origin in origins]
+        return (np.array([distances for distances, times in rows], dtype=float).reshape(len(origins), -1),
+                np.array([times for distances, times in rows], dtype=float).reshape(len(origins), -1))
+
+class HeuristicProvider(TravelTimeProvider):
+    name = 'heuristic'
+
+    def __init__(self, detour_factor=DETOUR_FACTOR, speed=BUS_SPEED):
+        self.detour_factor = detour_factor
+        self.speed = speed
+
+    def one_to_many(self, origin, destinations):
+        distances = self.detour_factor * geodesic_distances(
+            origin.latitude, origin.longitude,
+            [place.latitude for place in destinations], [place.longitude for place in destinations])
+        return distances, distances//self.speed
+
+    # the whole matrix in one vectorized evaluation
+    def many_to_many(self, origins, destinations):
+        distances = self.detour_factor * geodesic_distances(
+            np.array([place.latitude for place in origins])[:, np.newaxis],
+            np.array([place.longitude for place in origins])[:, np.newaxis],
+            np.array([place.latitude for place in destinations])[np.newaxis, :],
+            np.array([place.longitude for place in destinations])[np.newaxis, :])
+        return distances, distances//self.speed
+
+class MatrixProvider(TravelTimeProvider):
+    # filename is a SCHOOL_pmDistance.csv; stop_ids name its rows when it has no binary store
+    def __init__(self, filename, stop_ids=None):
+        matrix_path, ids_path = matrix_store_paths(filename)
+        if os.path.isfile(matrix_path):
+            # a store older than the csv file is converted again
+            stop_ids = open_matrix_store(filename)[2]
+            self.distance_plane, self.time_plane = load_school_matrix(filename, stop_ids)
+        else:
+            if stop_ids is None:
+                raise ValueError('{} has no binary store, so stop_ids must name its rows'.format(filename))
+            self.distance_plane, self.time_plane = load_school_matrix(filename)
+        self.row_of = {str(stop): row for row, stop in enumerate(stop_ids)}
+        self.name = 'matrix:{}@{}'.format(filename, file_version(filename, matrix_path, ids_path))
+
+    def _rows(self, places):
+        missing = [place.id for place in places if place.id not in self.row_of]
+        if missing:
+            raise KeyError('{} has no rows for stops {}'.format(self.name, missing))
+        return np.array([self.row_of[place.id] for place in places], dtype=np.intp)
+
+    def one_to_many(self, origin, destinations):
+        row = self._rows([origin])[0]
+        columns = self._rows(destinations)
+        return (np.asarray(self.distance_plane[row])[columns].astype(float),
+                np.asarray(self.time_plane[row])[columns].astype(float))
+
+    def many_to_many(self, origins, destinations):
+        rows, columns = self._rows(origins), self._rows(destinations)
+        return (np.asarray(self.distance_plane[np.ix_(rows, columns)]).astype(float),
+                np.asarray(self.time_plane[np.ix_(rows, columns)]).astype(float))
+
+class RoadGraphProvider(TravelTimeProvider):
+    # a place is snapped to the nearest node of the network and reaches it in a straight
+    # line at access_speed; pairs the network does not connect get the heuristic estimate
+    def __init__(self, filename, access_speed=BUS_SPEED):
+        self.name = 'road:{}@{}'.format(filename, file_version(filename))
+        self.access_speed = access_speed
+        self.fallback = HeuristicProvider()
+        edges = pd.read_csv(filename, delimiter=',')
+        node_ids = pd.unique(np.concatenate([edges['from'].astype(str).values, edges['to'].astype(str).values]))
+        node_of = {node: i for i, node in enumerate(node_ids)}
+        self.latitude = np.zeros(len(node_ids))
+        self.longitude = np.zeros(len(node_ids))
+        for end in ['from', 'to']:
+            nodes = [node_of[node] for node in edges[end].astype(str)]
+            self.latitude[nodes] = edges[end + '_lat'].astype(float).values
+            self.longitude[nodes] = edges[end + '_lon'].astype(float).values
+
+        # adjacency lists of (next node, length, time); plain lists are the fastest to walk
+        self.adjacency = [[] for node in node_ids]
+        for row in edges.itertuples(index=False):
+            u, v = node_of[str(row[0])], node_of[str(row[3])]
+            self.adjacency[u].append((v, float(row.length), float(row.time)))
+            if not int(row.oneway):
+                self.adjacency[v].append((u, float(row.length), float(row.time)))
+
+        # nodes by cell of a GRID_CELL degree grid, so a place is only measured against
+        # the nodes around it; a cell is at least cell_meters wide in both directions
+        self.grid = {}
+        for node, cell in enumerate(zip(np.floor(self.latitude / GRID_CELL).astype(int),
+                                        np.floor(self.longitude / GRID_CELL).astype(int))):
+            self.grid.setdefault(cell, []).append(node)
+        max_latitude = min(89.0, float(np.abs(self.latitude).max()) + GRID_CELL) if len(node_ids) else 0.0
+        self.cell_meters = GRID_CELL * METERS_PER_DEGREE * np.cos(np.radians(max_latitude))
+        cells = np.array(list(self.grid) or [(0, 0)])
+        self.grid_bounds = (cells[:, 0].min(), cells[:, 0].max(), cells[:, 1].min(), cells[:, 1].max())
+
+    # nearest node to (latitude, longitude) and the straight-line distance to it: the
+    # rings of cells around the place are searched until no node of a further ring
+    # can be nearer than the nearest one found
+    def nearest_node(self, latitude, longitude):
+        row, column = int(np.floor(latitude / GRID_CELL)), int(np.floor(longitude / GRID_CELL))
+        first_row, last_row, first_column, last_column = self.grid_bounds
+        last_ring = max(abs(row - first_row), abs(row - last_row), abs(column - first_column),
+                        abs(column - last_column))
+        best_node, best_distance = None, np.inf
+        ring = 0
+        while ring <= last_ring and (best_node is None or (ring - 1) * self.cell_meters <= best_distance):
+            cells = [(row + i, column + j) for i in range(-ring, ring+1) for j in range(-ring, ring+1)
+                     if max(abs(i), abs(j)) == ring]
+            nodes = [node for cell in cells for node in self.grid.get(cell, [])]
+            if nodes:
+                distances = geodesic_distances(latitude, longitude, self.latitude[nodes], self.longitude[nodes])
+                k = int(np.argmin(distances))
+                if distances[k] < best_distance:
+                    best_node, best_distance = nodes[k], float(distances[k])
+            ring += 1
+        return best_node, best_distance
+
+    # nearest node of each place and the straight-line distance to it, each location
+    # measured once
+    def snap(self, places):
+        snapped = {}
+        for place in places:
+            location = (place.latitude, place.longitude)
+            if location not in snapped:
+                snapped[location] = self.nearest_node(*location)
+        return ([snapped[(place.latitude, place.longitude)][0] for place in places],
+                [snapped[(place.latitude, place.longitude)][1] for place in places])
+
+    # fastest time and its length from source to every node of targets
+    def dijkstra(self, source, targets):
+        times = {source: 0.0}
+        lengths = {source: 0.0}
+        remaining = set(targets)
+        settled = set()
+        heap = [(0.0, source)]
+        while heap and remaining:
+            time, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            remaining.discard(node)
+            for next_node, length, edge_time in self.adjacency[node]:
+                next_time = time + edge_time
+                if next_time < times.get(next_node, np.inf):
+                    times[next_node] = next_time
+                    lengths[next_node] = lengths[node] + length
+                    heapq.heappush(heap, (next_time, next_node))
+        return ({node: lengths[node] for node in settled if node in targets},
+                {node: times[node] for node in settled if node in targets})
+
+    def one_to_many(self, origin, destinations):
+        return tuple(plane[0] for plane in self.many_to_many([origin], destinations))
+
+    def many_to_many(self, origins, destinations):
+        origin_nodes, origin_access = self.snap(origins)
+        destination_nodes, destination_access = self.snap(destinations)
+        targets = set(destination_nodes)
+        distances = np.zeros((len(origins), len(destinations)))
+        times = np.zeros((len(origins), len(destinations)))
+        for i, (origin, node, access) in enumerate(zip(origins, origin_nodes, origin_access)):
+            lengths, node_times = self.dijkstra(node, targets)
+            for j, (destination, target) in enumerate(zip(destinations, destination_nodes)):
+                if origin.id == destination.id:
+                    continue
+                if target not in node_times:
+                    distances[i, j], times[i, j] = [x[0] for x in self.fallback.one_to_many(origin, [destination])]
+                    continue
+                legs = access + destination_access[j]
+                distances[i, j] = lengths[target] + legs
+                times[i, j] = node_times[target] + legs / self.access_speed
+        return distances, times
+
+class CachedProvider(TravelTimeProvider):
+    # provider with its answers kept in the sqlite3 file filename, at most max_pairs
+    # of them; the pairs used longest ago are dropped first. A place is cached by its
+    # id and coordinates, so a stop that moves is asked again, and pairs are cached
+    # under the provider's name, so pairs of an older version of its file are dropped
+    def __init__(self, provider, filename='travel_times.sqlite', max_pairs=CACHE_PAIRS):
+        self.provider = provider
+        self.name = provider.name
+        self.max_pairs = max_pairs
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS pairs (provider TEXT, origin TEXT, destination TEXT, '
+                                    'distance REAL, time REAL, used INTEGER, '
+                                    'PRIMARY KEY (provider, origin, destination))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pairs_used ON pairs (used)')
+            source, separator, version = self.name.rpartition('@')
+            if separator:
+                self.connection.execute('DELETE FROM pairs WHERE substr(provider, 1, ?) = ? AND provider != ?',
+                                        (len(source)+1, source+'@', self.name))
+        self.tick = self.connection.execute('SELECT COALESCE(MAX(used), 0) FROM pairs').fetchone()[0]
+
+    @staticmethod
+    def key(place):
+        return '{}@{:.6f},{:.6f}'.format(place.id, place.latitude, place.longitude)
+
+    def one_to_many(self, origin, destinations):
+        return tuple(plane[0] for plane in self.many_to_many([origin], destinations))
+
+    # batches of origins and destinations small enough for one query each, with the
+    # placeholders of their IN lists
+    @staticmethod
+    def batches(origin_keys, keys):
+        batch_size = SQL_PARAMETERS // 2
+        for start in range(0, len(origin_keys), batch_size):
+            origin_batch = origin_keys[start:start+batch_size]
+            for key_start in range(0, len(keys), batch_size):
+                batch = keys[key_start:key_start+batch_size]
+                yield (origin_batch, batch, ','.join('?' for key in origin_batch), ','.join('?' for key in batch))
+
+    # the pairs of the cache are looked up together, and the origins that miss any of
+    # them are asked of the provider in one many_to_many call
+    def many_to_many(self, origins, destinations):
+        origin_keys = [self.key(place) for place in origins]
+        keys = [self.key(place) for place in destinations]
+        unique_origins = list(dict.fromkeys(origin_keys))
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            self.tick += 1
+            cached = {}
+            # batches with pairs not marked used in the last CACHE_RECENT calls
+            stale = []
+            for origin_batch, batch, origin_marks, marks in self.batches(unique_origins, unique_keys):
+                query = ('SELECT origin, destination, distance, time, used FROM pairs WHERE provider = ? '
+                         'AND origin IN ({}) AND destination IN ({})'.format(origin_marks, marks))
+                oldest = self.tick
+                for origin, destination, distance, time, used in self.connection.execute(
+                        query, [self.name] + origin_batch + batch):
+                    cached[(origin, destination)] = (distance, time)
+                    oldest = min(oldest, used)
+                if oldest <= self.tick - CACHE_RECENT:
+                    stale.append((origin_batch, batch, origin_marks, marks))
+
+            missing = [i for i, origin_key in enumerate(origin_keys)
+                       if any((origin_key, key) not in cached for key in keys)]
+            # one row per origin that misses a pair, each origin asked once
+            first_missing = list({origin_keys[i]: i for i in reversed(missing)}.values())
+            if first_missing:
+                distances, times = self.provider.many_to_many([origins[i] for i in first_missing], destinations)
+                for row, i in enumerate(first_missing):
+                    for j, key in enumerate(keys):
+                        cached[(origin_keys[i], key)] = (float(distances[row][j]), float(times[row][j]))
+
+            with self.connection:
+                if first_missing:
+                    self.connection.executemany(
+                        'INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?)',
+                        [(self.name, origin_keys[i], key) + cached[(origin_keys[i], key)] + (self.tick,)
+                         for i in first_missing for key in unique_keys])
+                # pairs found in the cache only have their last use moved on, and only
+                # when it is CACHE_RECENT calls old, so a warm cache is not written again
+                for origin_batch, batch, origin_marks, marks in stale:
+                    query = ('UPDATE pairs SET used = ? WHERE provider = ? AND used <= ? '
+                             'AND origin IN ({}) AND destination IN ({})'.format(origin_marks, marks))
+                    self.connection.execute(query, [self.tick, self.name, self.tick - CACHE_RECENT] +
+                                            origin_batch + batch)
+                if first_missing:
+                    self.evict()
+        return (np.array([[cached[(origin_key, key)][0] for key in keys] for origin_key in origin_keys],
+                         dtype=float).reshape(len(origins), len(destinations)),
+                np.array([[cached[(origin_key, key)][1] for key in keys] for origin_key in origin_keys],
+                         dtype=float).reshape(len(origins), len(destinations)))
+
+    # drop the pairs used longest ago beyond max_pairs
+    def evict(self):
+        count = self.connection.execute('SELECT COUNT(*) FROM pairs').fetchone()[0]
+        if count > self.max_pairs:
+            self.connection.execute('DELETE FROM pairs WHERE rowid IN '
+                                    '(SELECT rowid FROM pairs ORDER BY used LIMIT ?)', (count - self.max_pairs,))
+
+    def close(self):
+        self.connection.close()
+
+# provider named by spec: 'heuristic', 'matrix:SCHOOL_pmDistance.csv' or
+# 'road:network.csv', cached in cache_file unless it is None
+def open_provider(spec='heuristic', cache_file=None, max_pairs=CACHE_PAIRS):
+    kind, _, filename = spec.partition(':')
+    if kind == 'heuristic':
+        provider = HeuristicProvider()
+    elif kind == 'matrix':
+        provider = MatrixProvider(filename)
+    elif kind == 'road':
+        provider = RoadGraphProvider(filename)
+    else:
+        raise ValueError('Unknown travel time provider {}'.format(spec))
+    if cache_file is None:
+        return provider
+    return CachedProvider(provider, cache_file, max_pairs)
+
+# integer (distance, time) planes between the stops of a school's rows of Tier*_pm.csv
+# (school first), in the layout of SCHOOL_pmDistance.csv
+def build_planes(provider, school_stops):
+    places = places_of(school_stops[1:])
+    distances, times = provider.many_to_many(places, places)
+    np.fill_diagonal(distances, 0)
+    np.fill_diagonal(times, 0)
+    return np.rint(distances).astype(np.int64), np.rint(times).astype(np.int64)
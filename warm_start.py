@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Initial routes for warm-starting the routing search from a previous plan.
+
+The routes of an earlier run, read back from Tier*\\SCHOOL_pmRouteData.csv, are
+matched to the current stops by stop name. Stops that no longer exist are dropped,
+routes that are now over capacity shed their last stops, and stops that are new or
+were shed are put back with cheapest insertion, so the solver starts from a complete
+plan close to the last one.
+"""
+
+import os
+import pandas as pd
+
+# stop names of every route in a SCHOOL_pmRouteData.csv file, in driving order
+# and without the school itself; None if there is no file yet
+def read_route_file(filename):
+    if not os.path.isfile(filename):
+        return None
+    route_data = pd.read_csv(filename, delimiter=',')
+    route_data = route_data.sort_values(['route', 'order'], kind='stable')
+    return [[str(name) for name in group['stop name']][1:] for route, group in route_data.groupby('route', sort=True)]
+
+# time to drive a route of nodes from the school, dropping off at every stop
+def route_time(route, time_matrix):
+    nodes = [0] + route
+    return sum(time_matrix[nodes[i]][nodes[i+1]] for i in range(len(nodes)-1))
+
+# cheapest position to insert node into routes without breaking the capacity of
+# the bus or max_route_time; (added time, route, position) or None
+def cheapest_insertion(node, routes, loads, data):
+    time_matrix = data['time_matrix']
+    best = None
+    for r, route in enumerate(routes):
+        if loads[r] + data['students'][node] > data['vehicle_capacities'][r]:
+            continue
+        nodes = [0] + route
+        current = route_time(route, time_matrix)
+        for pos in range(len(route)+1):
+            if pos < len(route):
+                added = (time_matrix[nodes[pos]][node] + time_matrix[node][nodes[pos+1]] -
+                         time_matrix[nodes[pos]][nodes[pos+1]])
+            else:
+                added = time_matrix[nodes[pos]][node]
+            if current + added > data['max_route_time']:
+                continue
+            if best is None or added < best[0]:
+                best = (added, r, pos)
+    return best
+
+# match the previous routes to the nodes of the data model and repair them into a
+# complete set of routes; None if some stop cannot be placed on any bus
+def repair_routes(previous_routes, data):
+    node_of = {str(name): node for node, name in enumerate(data['stop_names']) if node > 0}
+    num_vehicles = data['num_vehicles']
+    capacities = data['vehicle_capacities']
+
+    # keep the stops that still exist, once each, on the buses the model has
+    routes = []
+    seen = set()
+    for names in previous_routes[:num_vehicles]:
+        route = []
+        for name in names:
+            node = node_of.get(name)
+            if node is not None and node not in seen:
+                seen.add(node)
+                route.append(node)
+        routes.append(route)
+
+    # shed stops from the end of routes that are now over capacity or too long
+    unassigned = [node for node in range(1, len(data['stop_names'])) if node not in seen]
+    loads = []
+    for r, route in enumerate(routes):
+        while route and (sum(data['students'][node] for node in route) > capacities[r] or
+                         route_time(route, data['time_matrix']) > data['max_route_time']):
+            unassigned.append(route.pop())
+        loads.append(sum(data['students'][node] for node in route))
+
+    # put the new and shed stops back, biggest first, opening empty buses when needed
+    unassigned.sort(key=lambda node: -data['students'][node])
+    for node in unassigned:
+        best = cheapest_insertion(node, routes, loads, data)
+        if best is None and [] not in routes and len(routes) < num_vehicles:
+            routes.append([])
+            loads.append(0)
+            best = cheapest_insertion(node, routes, loads, data)
+        if best is None:
+            return None
+        added, r, pos = best
+        routes[r].insert(pos, node)
+        loads[r] += data['students'][node]
+
+    # route i is driven by bus i, so empty routes stay in place
+    return routes